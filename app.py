@@ -1,11 +1,27 @@
-from flask import Flask, render_template, request, session, jsonify, redirect, url_for, Response
-import os, requests
-from dotenv import load_dotenv
-from services import AnimeDataClient, StreamClient
-import database
-db = database.UserManager()
-
-load_dotenv()
+from flask import Flask, render_template, request, session, jsonify, redirect, url_for, Response, g, send_file
+from flask import before_render_template, template_rendered
+import os, math, functools, time, logging, threading
+from config import load_env
+
+load_env()
+
+from services import AnimeDataClient, StreamClient, ResponseCache, make_session, fetch_all, session_stats
+from services import EPISODE_PAGE_SIZE, info_summary, episode_page, rate_limiter, client_key, negotiate_payload, Degraded
+from metrics import REGISTRY, histogram
+from assets import AssetPipeline, IMMUTABLE
+
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+)
+log = logging.getLogger('shiro.app')
+
+REQUEST_LATENCY = histogram(
+    'shiro_http_request_seconds', 'Flask request handling time', ('endpoint', 'method', 'status'),
+)
+TEMPLATE_RENDER = histogram(
+    'shiro_template_render_seconds', 'Jinja template render time', ('template',),
+)
 
 CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
@@ -23,8 +39,159 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
 
 # Initialize Clients
+# Constructing them is cheap: HTTP sessions, the DB pool and the modules behind
+# them (requests, psycopg2) are only set up on first use, so a serverless cold
+# start only pays for what its first request needs.
 anime_client = AnimeDataClient()
 stream_client = StreamClient()
+response_cache = ResponseCache(maxsize=500)
+
+# Static assets: templates link fingerprinted bundles through asset_url(), and
+# /assets/ serves them precompressed with far-future cache headers
+assets = AssetPipeline()
+
+@app.template_global()
+def asset_url(endpoint='static', **values):
+    """url_for drop-in: static files resolve to their content-hashed /assets/ URL."""
+    if endpoint == 'static':
+        name = assets.resolve(values.get('filename', ''))
+        if name is not None:
+            values.pop('filename')
+            return url_for('asset', name=name, **values)
+    return url_for(endpoint, **values)
+
+@app.route('/assets/<path:name>')
+def asset(name):
+    found = assets.lookup(name, request.accept_encodings)
+    if found is None:
+        return render_template('error.html', message="Page not found"), 404
+    body, encoding = found
+    if isinstance(body, bytes):
+        response = Response(body, mimetype=assets.mimetype(name))
+    else:
+        response = send_file(body, mimetype=assets.mimetype(name), conditional=False, etag=False)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = IMMUTABLE
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+_db = None
+_oauth_session = None
+_init_lock = threading.Lock()
+
+def get_db():
+    global _db
+    if _db is None:
+        with _init_lock:
+            if _db is None:
+                import database
+                _db = database.UserManager()
+    return _db
+
+def get_oauth_session():
+    # Discord OAuth gets its own keep-alive pool, separate from the upstream APIs
+    global _oauth_session
+    if _oauth_session is None:
+        with _init_lock:
+            if _oauth_session is None:
+                _oauth_session = make_session()
+    return _oauth_session
+
+# --- Instrumentation ---
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    start = g.pop('request_start', None)
+    if start is not None:
+        REQUEST_LATENCY.observe(
+            time.perf_counter() - start,
+            endpoint=request.endpoint or 'unmatched',
+            method=request.method,
+            status=response.status_code,
+        )
+    return response
+
+def _render_started(sender, template, context, **extra):
+    g.render_start = time.perf_counter()
+
+def _render_finished(sender, template, context, **extra):
+    start = g.pop('render_start', None)
+    if start is not None:
+        TEMPLATE_RENDER.observe(time.perf_counter() - start, template=template.name)
+
+before_render_template.connect(_render_started, app)
+template_rendered.connect(_render_finished, app)
+
+def collect_app_metrics():
+    stats = response_cache.stats()
+    yield 'shiro_response_cache_requests_total', 'counter', 'Encoded response cache lookups', {'result': 'hit'}, stats['hits']
+    yield 'shiro_response_cache_requests_total', 'counter', 'Encoded response cache lookups', {'result': 'miss'}, stats['misses']
+    sessions = (('anime', anime_client._session), ('stream', stream_client._session), ('oauth', _oauth_session))
+    for name, sess in sessions:
+        if sess is None:
+            continue
+        for host, conn in session_stats(sess).items():
+            labels = {'client': name, 'host': host}
+            yield 'shiro_http_connections_opened_total', 'counter', 'Upstream TCP/TLS connections opened', labels, conn['connections']
+            yield 'shiro_http_pooled_requests_total', 'counter', 'Requests sent over pooled connections', labels, conn['requests']
+
+REGISTRY.add_collector(collect_app_metrics)
+
+@app.route('/metrics')
+def metrics():
+    # Optional shared secret so the endpoint isn't public on Vercel
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return 'Forbidden', 403
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+def payload_response(payload, max_age=60, s_maxage=None):
+    """Serves an EncodedPayload as negotiated by services.negotiate_payload."""
+    status, body, headers = negotiate_payload(
+        payload, request.headers.get('Accept-Encoding', ''), request.headers.get('If-None-Match'), max_age, s_maxage,
+    )
+    if status == 304:
+        return Response(status=304, headers=headers)
+    return Response(body, headers=headers, mimetype='application/json')
+
+def cached_json(ttl=60, max_age=60, s_maxage=None):
+    """
+    For JSON API routes: the view returns plain data, which is encoded once
+    and kept in response_cache for `ttl` seconds per route, arguments and query string.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))))
+            payload = response_cache.get_or_encode(key, lambda: view(*args, **kwargs), ttl)
+            return payload_response(payload, max_age=max_age, s_maxage=ttl if s_maxage is None else s_maxage)
+        return wrapper
+    return decorator
+
+def rate_limited(rule):
+    """
+    Per-client token bucket (services.RATE_LIMITS[rule]) for routes that pass
+    free-form input to upstream. Goes above @cached_json: over the limit the
+    client gets a 429 with Retry-After, never a cached 429.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # Keyed by address, not session: reading the session would add Vary: Cookie to cacheable responses
+            retry_after = rate_limiter.hit(rule, client_key(request.remote_addr, request.headers.get('X-Forwarded-For')))
+            if retry_after:
+                headers = {'Retry-After': str(math.ceil(retry_after))}
+                if request.path.startswith('/api/'):
+                    return jsonify({'error': 'Too many requests'}), 429, headers
+                return render_template('error.html', message="Too many requests, please slow down"), 429, headers
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # Home page
 @app.route('/')
@@ -40,41 +207,53 @@ def index():
 
 # --- API Endpoints for Home Page Hydration ---
 
+@app.route('/api/home/feed')
+@cached_json(ttl=30, s_maxage=60)
+def api_home_feed():
+    return anime_client.get_home_feed()
+
 @app.route('/api/home/spotlight')
+@cached_json(ttl=60, s_maxage=120)
 def api_home_spotlight():
     data = anime_client.get_spotlight()
-    return jsonify(data if data else [])
+    return data if data else []
 
 @app.route('/api/home/recent-episodes')
+@cached_json(ttl=60, s_maxage=120)
 def api_home_recent():
     data = anime_client.get_recent_episodes()
-    return jsonify(data if data else {})
+    return data if data else {}
 
 @app.route('/api/home/new-releases')
+@cached_json(ttl=60, s_maxage=120)
 def api_home_new_releases():
     data = anime_client.get_new_releases()
-    return jsonify(data if data else {})
+    return data if data else {}
 
 @app.route('/api/home/upcoming')
+@cached_json(ttl=60, s_maxage=120)
 def api_home_upcoming():
     data = anime_client.get_top_upcoming()
-    return jsonify(data if data else {})
+    return data if data else {}
 
 @app.route('/api/home/completed')
+@cached_json(ttl=60, s_maxage=120)
 def api_home_completed():
     data = anime_client.get_latest_completed()
-    return jsonify(data if data else {})
+    return data if data else {}
 
 @app.route('/api/home/schedule')
+@cached_json(ttl=60, s_maxage=120)
 def api_home_schedule():
     data = anime_client.get_schedule()
-    return jsonify(data if data else {})
+    return data if data else {}
 
 # Search anime
 @app.route('/search')
+@rate_limited('search')
 def search():
     query = request.args.get('q', '')
-    page = request.args.get('page', 1, type=int)
+    page = max(1, request.args.get('page', 1, type=int))
     if not query:
         # Fallback to specials if no query, preserving original logic
         results = anime_client.fetch('specials', {"page": page})
@@ -89,24 +268,28 @@ def search():
 
 # Get search suggestions (AJAX)
 @app.route('/api/suggestions')
+@rate_limited('suggest')
+@cached_json(ttl=300, max_age=300)
 def suggestions():
-    query = request.args.get('q', '')
-    if not query:
-        return jsonify([])
-    
-    data = anime_client.get_search_suggestions(query)
-    return jsonify(data if data else [])
+    return anime_client.get_search_suggestions(request.args.get('q', ''))
 
 # Anime details page
 @app.route('/anime/<anime_id>')
 def anime_info(anime_id):
-    info = anime_client.get_info(anime_id)
+    # Info and the sidebar's popular list don't depend on each other, fetch them together
+    results = fetch_all({
+        'info': lambda: anime_client.get_info(anime_id),
+        'most_popular': anime_client.get_spotlight,
+    })
+    info = results['info']
     
     if not info:
+        if 'info' in results.missed:
+            # Upstream didn't answer in time, which says nothing about whether the anime exists
+            return render_template('error.html', message="Anime details are temporarily unavailable"), 503
         return render_template('error.html', message="Anime not found"), 404
     
-    # Fetch popular data for the sidebar
-    most_popular = anime_client.get_spotlight()    
+    most_popular = results['most_popular'] or []
     return render_template('anime_info.html', anime=info, most_popular=most_popular)
 
 # Watch episode
@@ -116,16 +299,22 @@ def watch(episode_id):
     dub = request.args.get('dub', 'false').lower() == 'true'
     category = "dub" if dub else "sub"
     try:
-        # Call Stream Client
-        api_response = stream_client.get_stream_data(episode_id, category, ep)
+        # Stream links and anime info (for the breadcrumbs/details) are independent
+        results = fetch_all({
+            'stream': lambda: stream_client.get_stream_data(episode_id, category, ep),
+            'info': lambda: anime_client.get_info(episode_id),
+        })
+        api_response = results['stream']
 
         if not api_response or not api_response.get("ok") or api_response.get("count") == 0:
              # If stream fails, we might still want to show the page but with an error message
              # But original logic returned 503.
             return render_template('error.html', message="Streaming service unavailable", alt_link="https://anikai.to/watch/" + episode_id + "#ep=" + ep), 503
 
-        # We need anime info for the breadcrumbs/details on the watch page
-        anime_details = anime_client.get_info(episode_id)
+        anime_details = results['info']
+        # Binge watching: warm the next episode while this one plays
+        total = len(anime_details.get('episodes') or []) if anime_details else None
+        stream_client.prefetch_adjacent(episode_id, category, ep, total=total)
         
         return render_template(
             'watch.html',
@@ -137,7 +326,7 @@ def watch(episode_id):
         )
 
     except Exception as e:
-        print(f"Flask Error in watch: {e}")
+        log.exception("Flask Error in watch: %s", e)
         return render_template('error.html', message="Internal Server Error"), 500
 
 # Browse by category
@@ -160,8 +349,9 @@ def browse(category):
 
 # Browse by genre
 @app.route('/genre/<genre_name>')
+@rate_limited('genre')
 def browse_genre(genre_name):
-    page = request.args.get('page', 1, type=int)
+    page = max(1, request.args.get('page', 1, type=int))
     
     data = anime_client.get_by_genre(genre_name, page)
     return render_template('browse.html', 
@@ -172,31 +362,77 @@ def browse_genre(genre_name):
 
 # API endpoint for dynamic loading
 @app.route('/api/anime/<anime_id>')
+@cached_json(ttl=300, max_age=300, s_maxage=600)
 def api_anime_info(anime_id):
-    info = anime_client.get_info(anime_id)
-    return jsonify(info if info else {})
+    # Without the episode list; that is paged through /api/anime/<id>/episodes
+    info = anime_client.get_info_data(anime_id)
+    return info_summary(info) if info else Degraded()
+
+@app.route('/api/anime/<anime_id>/episodes')
+@cached_json(ttl=300, max_age=300, s_maxage=600)
+def api_anime_episodes(anime_id):
+    page = max(1, request.args.get('page', 1, type=int))
+    per_page = min(500, max(1, request.args.get('per_page', EPISODE_PAGE_SIZE, type=int)))
+    return episode_page(anime_client.get_info_data(anime_id), page, per_page)
 
 # API endpoint for streaming links
 @app.route('/api/search-suggestions/<search>')
+@rate_limited('suggest')
+@cached_json(ttl=300, max_age=300)
 def api_search_suggest(search):
     # This route name is confusing in original code vs 'suggestions' route.
     # Original: fetch_api(f'search-suggestions/{search}')
-    # It might be an alternative way to search.
-    data = anime_client.fetch(f'search-suggestions/{search}')
-    return jsonify(data if data else {})
+    # Answered from the local title index when it has enough matches.
+    return anime_client.suggest(search)
 
 @app.route('/api/watch/<episode_id>')
+@cached_json(ttl=60, max_age=60)
 def api_watch(episode_id):
     dub = request.args.get('dub', 'false').lower() == 'true'
     category = "dub" if dub else "sub"
     streams = stream_client.get_stream_data(episode_id, category, request.args.get('ep', '1'))
-    return jsonify(streams if streams else {})
+    return streams if streams else {}
+
+@app.route('/api/progress', methods=['POST'])
+def api_progress():
+    # Player heartbeat; buffered in memory and written in batches by UserManager
+    uid = session.get('uid')
+    if not uid:
+        return jsonify({'error': 'not logged in'}), 401
+
+    # JSON only: a cross-site form can't send application/json without a CORS preflight
+    if not request.is_json:
+        return jsonify({'error': 'expected application/json'}), 415
+    data = request.get_json(silent=True) or {}
+    anime_id = str(data.get('anime_id') or '')[:200]
+    episode = str(data.get('episode') or '')[:20]
+    try:
+        position = float(data.get('position', 0))
+        duration = float(data['duration']) if data.get('duration') else None
+    except (TypeError, ValueError):
+        return jsonify({'error': 'invalid position'}), 400
+    if not anime_id or not episode or not 0 <= position <= 86400:
+        return jsonify({'error': 'invalid heartbeat'}), 400
+
+    get_db().record_progress(
+        uid, anime_id, episode, position, duration,
+        title=(data.get('title') or None) and str(data['title'])[:300],
+        image=(data.get('image') or None) and str(data['image'])[:500],
+    )
+    return '', 204
 
 @app.route('/profile')
 def profile():
     if not session.get('user', None):
         return redirect(url_for('login'))
-    return render_template('profile.html')
+    account = history = None
+    if session.get('uid'):
+        account = get_db().get_user_by_id(session['uid'])
+        try:
+            history = get_db().get_watch_history(session['uid'])
+        except Exception as e:
+            log.warning("Couldn't load watch history: %s", e)
+    return render_template('profile.html', account=account, history=history or [])
 
 @app.route('/login')
 def login():
@@ -219,6 +455,7 @@ def callback():
         return jsonify({'error': request.args['error']})
 
     if 'code' in request.args:
+        import requests  # only the login callback needs it directly
         code = request.args['code']
         
         try:
@@ -234,7 +471,7 @@ def callback():
                 'Content-Type': 'application/x-www-form-urlencoded'
             }
             
-            response = requests.post(TOKEN_URL, data=data, headers=headers)
+            response = get_oauth_session().post(TOKEN_URL, data=data, headers=headers, timeout=10)
             response.raise_for_status()
             tokens = response.json()
             access_token = tokens['access_token']
@@ -243,11 +480,11 @@ def callback():
             user_headers = {
                 'Authorization': f"Bearer {access_token}"
             }
-            user_response = requests.get(USER_INFO_URL, headers=user_headers)
+            user_response = get_oauth_session().get(USER_INFO_URL, headers=user_headers, timeout=10)
             user_response.raise_for_status()
             user_data = user_response.json()
 
-            db.sync_oauth_user(
+            account = get_db().sync_oauth_user(
                 provider="discord",
                 provider_id=user_data['id'],
                 display_name=user_data.get('global_name') or user_data.get('username', ''),
@@ -256,10 +493,11 @@ def callback():
                 avatar=user_data.get('avatar', '')
             )
             session['user'] = user_data
+            session['uid'] = account['uid']
             return redirect(url_for('index'))
         
         except requests.exceptions.RequestException as e:
-            print(f"Discord OAuth Error: {e}")
+            log.warning("Discord OAuth Error: %s", e)
             return redirect(url_for('login'))
     
     return 'Unknown Error', 400
@@ -267,6 +505,7 @@ def callback():
 @app.route('/logout')
 def logout():
     session.pop('user', None)
+    session.pop('uid', None)
     return redirect(url_for('index'))
 
 @app.route('/terms-of-service')
@@ -277,12 +516,47 @@ def terms():
 def privacy():
     return render_template('privacy.html')
 
+# Sitemap: built from a background crawl, so serving it never touches upstream
+_sitemap = None
+_sitemap_lock = threading.Lock()
+
+def get_sitemap():
+    global _sitemap
+    if _sitemap is None:
+        with _sitemap_lock:
+            if _sitemap is None:
+                from sitemap_generator import Sitemap
+                _sitemap = Sitemap(anime_client)
+    _sitemap.ensure_started()
+    return _sitemap
+
+def sitemap_response(render):
+    """Streams render(snapshot, base_url), gzipped if accepted; 304 if unchanged since If-Modified-Since."""
+    from sitemap_generator import encode_stream
+    snapshot = get_sitemap().snapshot
+    # Rendering is lazy, so this only checks the shard exists before any 304
+    chunks = render(snapshot, request.url_root.rstrip('/'))
+    if chunks is None:
+        return render_template('error.html', message="Page not found"), 404
+    if request.if_modified_since and request.if_modified_since >= snapshot.last_modified:
+        response = Response(status=304)
+    else:
+        compress = 'gzip' in request.accept_encodings
+        response = Response(encode_stream(chunks, compress), mimetype='application/xml')
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.last_modified = snapshot.last_modified
+    response.headers['Cache-Control'] = 'public, max-age=3600, s-maxage=21600'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
 @app.route('/sitemap.xml')
 def sitemap():
-    from sitemap_generator import generate_sitemap_xml
-    base_url = request.url_root.rstrip('/')
-    xml_content = generate_sitemap_xml(base_url)
-    return Response(xml_content, mimetype='application/xml')
+    return sitemap_response(lambda snapshot, base_url: snapshot.render_index(base_url))
+
+@app.route('/sitemaps/<int:shard>.xml')
+def sitemap_shard(shard):
+    return sitemap_response(lambda snapshot, base_url: snapshot.render_shard(base_url, shard))
 
 # Error handlers
 @app.errorhandler(404)
@@ -0,0 +1,145 @@
+"""
+Async serving mode.
+
+The /api/* JSON endpoints run as coroutines on the async clients in
+async_services.py, so one process can keep thousands of upstream requests in
+flight without a thread per request. The home feed routes are the exception:
+they read the stale-while-revalidate home tier shared with the Flask routes. Every other route (pages, OAuth, sitemap)
+falls through to the Flask app unchanged.
+
+Run with:
+    uvicorn asgi:app --workers 4
+"""
+import math
+import contextlib
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, JSONResponse
+from starlette.routing import Mount, Route
+from a2wsgi import WSGIMiddleware
+from async_services import AsyncAnimeDataClient, AsyncStreamClient, make_async_http_client
+from services import EPISODE_PAGE_SIZE, info_summary, episode_page, rate_limiter, client_key, negotiate_payload, Degraded
+from app import app as flask_app, response_cache, anime_client as home_client
+
+anime_client = AsyncAnimeDataClient()
+stream_client = AsyncStreamClient()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # httpx clients are bound to the running event loop
+    async with make_async_http_client() as http:
+        anime_client.http = http
+        stream_client.http = http
+        yield
+
+
+def payload_response(request, payload, max_age=60, s_maxage=None):
+    """app.payload_response for Starlette requests; the negotiation itself is shared."""
+    status, body, headers = negotiate_payload(
+        payload, request.headers.get('accept-encoding', ''), request.headers.get('if-none-match'), max_age, s_maxage,
+    )
+    if status == 304:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+
+def cached_json(ttl=60, max_age=60, s_maxage=None):
+    """app.cached_json for coroutine views; shares app.response_cache."""
+    def decorator(view):
+        async def endpoint(request):
+            key = ('asgi', request.url.path, tuple(sorted(request.query_params.multi_items())))
+            payload = response_cache.get(key)
+            if payload is None:
+                # Encoding (json, gzip, brotli) is CPU work; keep it off the event loop
+                payload = await run_in_threadpool(response_cache.put, key, await view(request), ttl)
+            return payload_response(request, payload, max_age=max_age, s_maxage=ttl if s_maxage is None else s_maxage)
+        return endpoint
+    return decorator
+
+
+def rate_limited(rule):
+    """app.rate_limited for coroutine views: 429 with Retry-After once the client's bucket is empty."""
+    def decorator(view):
+        async def endpoint(request):
+            host = request.client.host if request.client else None
+            # Threadpool: the sqlite backend runs a write transaction per hit
+            retry_after = await run_in_threadpool(rate_limiter.hit, rule, client_key(host, request.headers.get('x-forwarded-for')))
+            if retry_after:
+                return JSONResponse({'error': 'Too many requests'}, status_code=429,
+                                    headers={'Retry-After': str(math.ceil(retry_after))})
+            return await view(request)
+        return endpoint
+    return decorator
+
+
+# Home sections are served from the same stale-while-revalidate tier as the
+# Flask routes (services.home_cache, kept warm by hot_refresher), through the
+# Flask app's client. Hits return at once; the rare synchronous load runs on a
+# worker thread.
+
+@cached_json(ttl=30, s_maxage=60)
+async def api_home_feed(request):
+    return await run_in_threadpool(home_client.get_home_feed)
+
+def home_section(getter, empty):
+    # `empty` is what the matching Flask route answers with when there's no data
+    @cached_json(ttl=60, s_maxage=120)
+    async def view(request):
+        data = await run_in_threadpool(getter)
+        return data if data else empty
+    return view
+
+@rate_limited('suggest')
+@cached_json(ttl=300, max_age=300)
+async def suggestions(request):
+    return await anime_client.get_search_suggestions(request.query_params.get('q', ''))
+
+@rate_limited('suggest')
+@cached_json(ttl=300, max_age=300)
+async def api_search_suggest(request):
+    return await anime_client.suggest(request.path_params['search'])
+
+@cached_json(ttl=300, max_age=300, s_maxage=600)
+async def api_anime_info(request):
+    info = await anime_client.get_info_data(request.path_params['anime_id'])
+    return info_summary(info) if info else Degraded()
+
+@cached_json(ttl=300, max_age=300, s_maxage=600)
+async def api_anime_episodes(request):
+    try:
+        page = max(1, int(request.query_params.get('page', 1)))
+        per_page = min(500, max(1, int(request.query_params.get('per_page', EPISODE_PAGE_SIZE))))
+    except ValueError:
+        page, per_page = 1, EPISODE_PAGE_SIZE
+    info = await anime_client.get_info_data(request.path_params['anime_id'])
+    return episode_page(info, page, per_page)
+
+@cached_json(ttl=60, max_age=60)
+async def api_watch(request):
+    dub = request.query_params.get('dub', 'false').lower() == 'true'
+    category = "dub" if dub else "sub"
+    streams = await stream_client.get_stream_data(
+        request.path_params['episode_id'], category, request.query_params.get('ep', '1')
+    )
+    return streams if streams else {}
+
+
+routes = [
+    Route('/api/home/feed', api_home_feed),
+    Route('/api/home/spotlight', home_section(home_client.get_spotlight, [])),
+    Route('/api/home/recent-episodes', home_section(home_client.get_recent_episodes, {})),
+    Route('/api/home/new-releases', home_section(home_client.get_new_releases, {})),
+    Route('/api/home/upcoming', home_section(home_client.get_top_upcoming, {})),
+    Route('/api/home/completed', home_section(home_client.get_latest_completed, {})),
+    Route('/api/home/schedule', home_section(home_client.get_schedule, {})),
+    Route('/api/suggestions', suggestions),
+    Route('/api/search-suggestions/{search}', api_search_suggest),
+    Route('/api/anime/{anime_id}', api_anime_info),
+    Route('/api/anime/{anime_id}/episodes', api_anime_episodes),
+    Route('/api/watch/{episode_id}', api_watch),
+    # Everything else is served by the Flask app
+    Mount('/', app=WSGIMiddleware(flask_app)),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
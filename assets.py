@@ -0,0 +1,238 @@
+"""
+Static asset pipeline: minified page bundles and fingerprinted files,
+precompressed with gzip (and brotli when installed), served with immutable
+cache headers.
+
+    python assets.py          # build static/dist/ and its manifest.json
+
+Templates call asset_url('static', filename=...) the way they would call
+url_for. With a build in static/dist the hashed name comes from the manifest
+and the file is served from disk. Without one (local development, or a
+deploy that skipped the build) each asset is built in memory the first time
+it is referenced, so pages work either way.
+"""
+import os
+import re
+import sys
+import json
+import gzip
+import hashlib
+import mimetypes
+import threading
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+MANIFEST_NAME = 'manifest.json'
+
+# Per-page stylesheets, in the order base.html loads them: skeleton.css,
+# then the page's own stylesheet, then base.css (which wins on conflicts).
+# Pages with inline <style> blocks keep loading skeleton.css and base.css
+# separately so their inline rules stay between the two.
+BUNDLES = {
+    'css/page-index.css': ['css/skeleton.css', 'css/index.css', 'css/base.css'],
+    'css/page-info.css': ['css/skeleton.css', 'css/info.css', 'css/base.css'],
+    'css/page-browse.css': ['css/skeleton.css', 'css/browse.css', 'css/base.css'],
+    'css/page-search.css': ['css/skeleton.css', 'css/search.css', 'css/base.css'],
+    'css/page-watch.css': ['css/skeleton.css', 'css/watch.css', 'css/base.css'],
+}
+# Never served by the app (README screenshot)
+IGNORE = {'preview.png'}
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# 'css/page-index.3f2a9c81d0.css' -> ('css/page-index', '.css'); see fingerprint()
+_HASHED = re.compile(r'^(.+)\.[0-9a-f]{10}(\.[^./]+)$')
+_STRINGS = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')''')
+
+
+def minify_css(css):
+    """Drops comments and insignificant whitespace; quoted strings are left alone."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    parts = _STRINGS.split(css)
+    for i in range(0, len(parts), 2):  # even indexes are outside strings
+        part = re.sub(r'\s+', ' ', parts[i])
+        part = re.sub(r'\s*([{};,>])\s*', r'\1', part)
+        parts[i] = part.replace(';}', '}')
+    return ''.join(parts).strip()
+
+
+def minify_js(js):
+    """
+    Conservative: strips comment-only lines, block comments that start a line,
+    indentation and blank lines. Line breaks are kept, so semicolon insertion,
+    regex literals and strings can't be broken by it.
+    """
+    js = re.sub(r'^\s*/\*.*?\*/[ \t]*$', '', js, flags=re.S | re.M)
+    lines = (line.strip() for line in js.splitlines())
+    return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+
+def fingerprint(path, content):
+    """'css/page-index.css' -> 'css/page-index.3f2a9c81d0.css'"""
+    root, ext = os.path.splitext(path)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:10]}{ext}'
+
+
+def compress(path, content):
+    """{'gzip': bytes, 'br': bytes} for text assets worth compressing; empty otherwise."""
+    if not path.endswith(COMPRESSIBLE):
+        return {}
+    variants = {'gzip': gzip.compress(content, 9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(content, quality=11)
+    # Tiny files can come out bigger
+    return {enc: body for enc, body in variants.items() if len(body) < len(content)}
+
+
+def render(path, static_dir=STATIC_DIR):
+    """Bytes for a logical asset path: a bundle, or a file under static/ (minified if CSS/JS)."""
+    if path in BUNDLES:
+        sources = BUNDLES[path]
+    elif os.path.isfile(os.path.join(static_dir, path)):
+        sources = [path]
+    else:
+        return None
+    if path.endswith(('.css', '.js')):
+        minify = minify_css if path.endswith('.css') else minify_js
+        texts = []
+        for source in sources:
+            with open(os.path.join(static_dir, source), encoding='utf-8') as f:
+                texts.append(minify(f.read()))
+        return '\n'.join(texts).encode('utf-8')
+    with open(os.path.join(static_dir, sources[0]), 'rb') as f:
+        return f.read()
+
+
+def logical_paths(static_dir=STATIC_DIR):
+    paths = set(BUNDLES)
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != os.path.join(static_dir, 'dist')]
+        for filename in filenames:
+            if filename in IGNORE or filename.startswith('.'):
+                continue
+            paths.add(os.path.relpath(os.path.join(dirpath, filename), static_dir).replace(os.sep, '/'))
+    return sorted(paths)
+
+
+def build(static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+    """Writes every asset (plus .gz/.br variants) under dist_dir and returns the manifest."""
+    manifest = {}
+    written = set()
+    for path in logical_paths(static_dir):
+        content = render(path, static_dir)
+        name = fingerprint(path, content)
+        manifest[path] = name
+        outputs = {name: content}
+        outputs.update({f'{name}.{"gz" if enc == "gzip" else enc}': body for enc, body in compress(path, content).items()})
+        for out_name, body in outputs.items():
+            out_path = os.path.join(dist_dir, out_name)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            with open(out_path, 'wb') as f:
+                f.write(body)
+            written.add(os.path.normpath(out_path))
+
+    with open(os.path.join(dist_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    written.add(os.path.normpath(os.path.join(dist_dir, MANIFEST_NAME)))
+
+    # Drop outputs of earlier builds
+    for dirpath, _, filenames in os.walk(dist_dir):
+        for filename in filenames:
+            path = os.path.normpath(os.path.join(dirpath, filename))
+            if path not in written:
+                os.remove(path)
+    return manifest
+
+
+class _Built:
+    __slots__ = ('content', 'variants')
+
+    def __init__(self, content, variants):
+        self.content = content
+        self.variants = variants
+
+
+class AssetPipeline:
+    """Resolves logical asset paths to fingerprinted names and finds the bytes to serve for them."""
+
+    def __init__(self, static_dir=STATIC_DIR, dist_dir=DIST_DIR):
+        self.static_dir = static_dir
+        self.dist_dir = dist_dir
+        self._manifest = None
+        self._names = {}  # logical path -> hashed name (in-memory mode)
+        self._built = {}  # hashed name -> _Built (in-memory mode)
+        self._lock = threading.Lock()
+
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            try:
+                with open(os.path.join(self.dist_dir, MANIFEST_NAME), encoding='utf-8') as f:
+                    self._manifest = json.load(f)
+            except (OSError, ValueError):
+                self._manifest = {}
+        return self._manifest
+
+    def resolve(self, path):
+        """Hashed name for a logical path, or None if it isn't an asset."""
+        path = path.lstrip('/')
+        if self.manifest:
+            return self.manifest.get(path)
+        name = self._names.get(path)
+        if name is None:
+            with self._lock:
+                name = self._names.get(path)
+                if name is None:
+                    content = render(path, self.static_dir) if path.split('/')[-1] not in IGNORE else None
+                    if content is None:
+                        return None
+                    name = fingerprint(path, content)
+                    self._built[name] = _Built(content, None)
+                    self._names[path] = name
+        return name
+
+    def lookup(self, name, accept_encodings=()):
+        """
+        (body or file path, content-encoding) for a hashed name, preferring
+        brotli, then gzip; None if unknown. Compressed variants are made on
+        first request in in-memory mode. In that mode a name handed out by
+        another worker is rebuilt from its logical path and served only if the
+        digest still matches, so pages work across workers and instances.
+        """
+        if '..' in name.split('/'):
+            return None
+        if self.manifest:
+            base = os.path.join(self.dist_dir, name)
+            for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+                if encoding in accept_encodings and os.path.isfile(base + suffix):
+                    return base + suffix, encoding
+            return (base, None) if os.path.isfile(base) else None
+
+        built = self._built.get(name)
+        if built is None:
+            match = _HASHED.match(name)
+            if match is None or self.resolve(match.group(1) + match.group(2)) != name:
+                return None
+            built = self._built[name]
+        if built.variants is None:
+            built.variants = compress(name, built.content)
+        for encoding in ('br', 'gzip'):
+            if encoding in accept_encodings and encoding in built.variants:
+                return built.variants[encoding], encoding
+        return built.content, None
+
+    @staticmethod
+    def mimetype(name):
+        return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+if __name__ == '__main__':
+    manifest = build()
+    for path, name in manifest.items():
+        print(f'{path:<32} -> {name}')
+    print(f'{len(manifest)} assets written to {os.path.relpath(DIST_DIR)}', file=sys.stderr)
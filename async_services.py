@@ -0,0 +1,254 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+import httpx
+from services import (
+    api_cache, api_cache_lock, payload_size, fetch_cache_key, stream_cache_key, suggestion_index,
+    get_breaker, endpoint_label, UPSTREAM_LATENCY, UPSTREAM_REQUESTS, SUGGEST_MIN_LOCAL,
+    PROJECTIONS, project_stream, upstream_budget, request_priority, suggestion_results, Degraded,
+)
+
+log = logging.getLogger('shiro.services')
+
+# Async counterparts of the clients in services.py, for the ASGI serving mode.
+# They share api_cache and the suggestion index with the sync clients, but talk
+# to upstream through one pooled httpx.AsyncClient instead of a thread per request.
+# Anything that can block or burn CPU (api_cache_lock, which Flask threads also
+# hold; SQLite cache I/O; index compaction; projections) runs in a worker
+# thread via asyncio.to_thread, never on the event loop.
+
+ASYNC_MAX_CONNECTIONS = int(os.getenv('ASYNC_MAX_CONNECTIONS', 1000))
+ASYNC_MAX_KEEPALIVE = int(os.getenv('ASYNC_MAX_KEEPALIVE', 100))
+
+def make_async_http_client():
+    """Pooled keep-alive client; one per event loop, opened in the ASGI lifespan."""
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(10.0, connect=5.0),
+        limits=httpx.Limits(
+            max_connections=ASYNC_MAX_CONNECTIONS,
+            max_keepalive_connections=ASYNC_MAX_KEEPALIVE,
+        ),
+        transport=httpx.AsyncHTTPTransport(retries=1),
+    )
+
+
+class _LeaderCancelled(Exception):
+    """The request leading an AsyncSingleFlight fetch was cancelled; its waiters start over."""
+
+
+class AsyncSingleFlight:
+    """
+    services.SingleFlight for coroutines: concurrent misses on a key await one
+    fetch. If the leading request is cancelled (client gone, deadline), its
+    waiters aren't: the first of them to resume leads a new fetch.
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self.leaders = 0
+        self.waiters = 0
+
+    async def do(self, key, func, *args, **kwargs):
+        while True:
+            future = self._futures.get(key)
+            if future is None:
+                break
+            self.waiters += 1
+            try:
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                continue
+
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        self.leaders += 1
+        try:
+            result = await func(*args, **kwargs)
+            future.set_result(result)
+            return result
+        except asyncio.CancelledError:
+            future.set_exception(_LeaderCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark it retrieved so a fetch nobody waited on doesn't warn
+            future.exception()
+            raise
+        finally:
+            del self._futures[key]
+
+    def stats(self):
+        return {'leaders': self.leaders, 'coalesced': self.waiters, 'in_flight': len(self._futures)}
+
+async_inflight = AsyncSingleFlight()
+
+
+def _cache_lookup(k):
+    with api_cache_lock:
+        return api_cache[k]
+
+def _cache_fill(k, value):
+    size = payload_size(value)  # before the lock, like services.cached_payload
+    with api_cache_lock:
+        try:
+            api_cache.setdefault(k, value, size=size)
+        except ValueError:
+            pass  # value too large
+
+
+def async_cached(key):
+    """services.cached_payload for coroutines, coalescing concurrent misses."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            try:
+                return await asyncio.to_thread(_cache_lookup, k)
+            except KeyError:
+                pass
+
+            async def load(*args, **kwargs):
+                # The shared level (services.shared_first) is checked by the one coroutine that loads
+                if api_cache.shared is not None:
+                    found, value = await asyncio.to_thread(api_cache.get_shared, k)
+                    if found:
+                        return value
+                return await func(*args, **kwargs)
+
+            value = await async_inflight.do(k, load, *args, **kwargs)
+            await asyncio.to_thread(_cache_fill, k, value)
+            return value
+        return wrapper
+    return decorator
+
+
+class AsyncBaseClient:
+    upstream = 'upstream'
+
+    def __init__(self, base_url, http=None):
+        self.base_url = base_url
+        self.http = http
+        self.breaker = get_breaker(base_url)
+
+    async def _get(self, endpoint, params=None):
+        """Internal get method with error handling."""
+        if not self.base_url:
+            log.error("Base URL not configured for %s", self.__class__.__name__)
+            return None
+        if self.http is None:
+            raise RuntimeError(f"{self.__class__.__name__} used outside the ASGI lifespan")
+
+        label = endpoint_label(self.upstream, endpoint)
+        if not self.breaker.allow():
+            UPSTREAM_REQUESTS.inc(upstream=self.upstream, endpoint=label, outcome='rejected')
+            return None
+        if not upstream_budget.try_spend(request_priority(self.upstream, label)):
+            self.breaker.release()
+            UPSTREAM_REQUESTS.inc(upstream=self.upstream, endpoint=label, outcome='over_budget')
+            return None
+
+        start = time.monotonic()
+        try:
+            url = f"{self.base_url}/{endpoint}"
+            response = await self.http.get(url, params=params, timeout=self.breaker.timeout())
+            response.raise_for_status()
+            data = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            elapsed = time.monotonic() - start
+            status = e.response.status_code if isinstance(e, httpx.HTTPStatusError) else None
+            self.breaker.record(status is not None and status < 500 and status != 429, elapsed)
+            UPSTREAM_LATENCY.observe(elapsed, upstream=self.upstream, endpoint=label)
+            UPSTREAM_REQUESTS.inc(upstream=self.upstream, endpoint=label, outcome='error')
+            log.warning("[%s] API Error: %s", self.__class__.__name__, e)
+            return None
+        except BaseException:
+            # e.g. the request was cancelled; frees a half-open probe slot
+            self.breaker.release()
+            raise
+        elapsed = time.monotonic() - start
+        self.breaker.record(True, elapsed)
+        UPSTREAM_LATENCY.observe(elapsed, upstream=self.upstream, endpoint=label)
+        UPSTREAM_REQUESTS.inc(upstream=self.upstream, endpoint=label, outcome='ok')
+        return data
+
+
+class AsyncAnimeDataClient(AsyncBaseClient):
+    """Async client for general anime data (Spotlight, Search, Info)."""
+    upstream = 'anime'
+
+    def __init__(self, http=None):
+        super().__init__(os.getenv('BASE_URL'), http)
+
+    async def _get(self, endpoint, params=None):
+        data = await super()._get(endpoint, params)
+        if data is not None:
+            data = await asyncio.to_thread(self._digest, endpoint, data)
+        return data
+
+    @staticmethod
+    def _digest(endpoint, data):
+        """Projects a payload and feeds it to the suggestion index (which may compact)."""
+        if endpoint in PROJECTIONS:
+            data = PROJECTIONS[endpoint](data)
+        if data:
+            suggestion_index.ingest(data)
+        return data
+
+    @async_cached(key=fetch_cache_key)
+    async def fetch(self, endpoint, params=None):
+        data = await self._get(endpoint, params)
+        if data is None:
+            found, stale = api_cache.serve_stale(fetch_cache_key(self, endpoint, params))
+            if found:
+                return stale
+            log.warning("No data received for endpoint '%s'", endpoint)
+        return data
+
+    async def get_info_data(self, anime_id):
+        """Info as cached: projected, with episodes packed into columns."""
+        return await self.fetch('info', {'id': anime_id})
+
+    async def get_search_suggestions(self, query):
+        if not query:
+            return {'results': []}
+        results = await asyncio.to_thread(suggestion_index.lookup, query)
+        local = len(results) >= SUGGEST_MIN_LOCAL
+        suggestion_index.record_answer(local)
+        if local:
+            return {'results': results}
+        data = await self.fetch('search-suggestions', {'query': query})
+        if data is None:
+            return Degraded(results=results)
+        return {'results': suggestion_results(data) or results}
+
+    async def suggest(self, query):
+        results = await asyncio.to_thread(suggestion_index.lookup, query)
+        local = len(results) >= SUGGEST_MIN_LOCAL
+        suggestion_index.record_answer(local)
+        if local:
+            return {'results': results}
+        data = await self.fetch(f'search-suggestions/{query}')
+        if data is None:
+            return Degraded(results=results)
+        return {'results': suggestion_results(data) or results}
+
+
+class AsyncStreamClient(AsyncBaseClient):
+    """Async client for streaming links."""
+    upstream = 'stream'
+
+    def __init__(self, http=None):
+        super().__init__(os.getenv('STREAM_URL'), http)
+
+    @async_cached(key=stream_cache_key)
+    async def get_stream_data(self, episode_id, category='sub', ep_num='1'):
+        params = {'ep': ep_num, 'category': category}
+        data = project_stream(await self._get(episode_id, params))
+        if data is None:
+            found, stale = api_cache.serve_stale(stream_cache_key(self, episode_id, category, ep_num))
+            if found:
+                return stale
+        return data
+
@@ -0,0 +1,110 @@
+"""
+Cold-start benchmark: how long a fresh interpreter takes to import app.py and
+answer its first request, which is what every serverless cold start pays.
+
+Each run is a new `python -X importtime` process, so nothing is shared between
+runs except the OS file cache. Reported: median/max import and first-request
+time, the slowest top-level imports of the median run, and any module from
+--forbid that got imported before the first request (those should be loaded
+lazily). Exits non-zero when the median import exceeds --budget-ms or a
+forbidden module is imported, so it can gate CI:
+
+    python -m bench.coldstart --runs 9 --budget-ms 350
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that only specific requests need; importing them at startup is a regression
+DEFAULT_FORBID = ('requests', 'urllib3', 'psycopg2', 'sqlite3', 'sitemap_generator', 'database')
+
+CHILD = r"""
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+loaded = sorted(m for m in sys.modules if '.' not in m)
+client = app.app.test_client()
+status = client.get(sys.argv[1]).status_code
+done = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (done - imported) * 1000,
+    'status': status,
+    'modules': loaded,
+}))
+"""
+
+
+def run_once(path):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'SECRET_KEY': env.get('SECRET_KEY', 'coldstart'),
+        'LOG_LEVEL': 'WARNING',
+        # A fresh instance has no cache snapshot to restore
+        'CACHE_SNAPSHOT_PATH': os.path.join(ROOT, '.coldstart-no-snapshot'),
+    })
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', CHILD, path],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result['top_imports'] = parse_importtime(proc.stderr)
+    return result
+
+
+def parse_importtime(stderr, depth=1):
+    """Cumulative microseconds per module imported at the given nesting depth."""
+    out = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if (len(name) - len(name.lstrip(' '))) // 2 == depth:
+            out.append((name.strip(), int(cumulative)))
+    return sorted(out, key=lambda item: item[1], reverse=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--path', default='/terms-of-service', help='first request; pick one that needs no upstream')
+    parser.add_argument('--budget-ms', type=float, help='fail if the median import takes longer')
+    parser.add_argument('--forbid', action='append', help=f'repeatable; default: {", ".join(DEFAULT_FORBID)}')
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+
+    runs = [run_once(args.path) for _ in range(args.runs)]
+    imports = [r['import_ms'] for r in runs]
+    firsts = [r['first_request_ms'] for r in runs]
+    median_run = sorted(runs, key=lambda r: r['import_ms'])[len(runs) // 2]
+    forbidden = sorted(set(args.forbid or DEFAULT_FORBID) & set(median_run['modules']))
+
+    print(f"import app       median {statistics.median(imports):7.1f} ms   max {max(imports):7.1f} ms")
+    print(f"first request    median {statistics.median(firsts):7.1f} ms   max {max(firsts):7.1f} ms   ({args.path} -> {median_run['status']})")
+    print("slowest top-level imports (median run):")
+    for name, micros in median_run['top_imports'][:args.top]:
+        print(f"  {name:<24}{micros / 1000:8.1f} ms")
+    if forbidden:
+        print(f"imported eagerly but should be lazy: {', '.join(forbidden)}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'runs': runs}, f, indent=2)
+
+    failed = bool(forbidden)
+    if args.budget_ms is not None and statistics.median(imports) > args.budget_ms:
+        print(f"over budget: {statistics.median(imports):.1f} ms > {args.budget_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
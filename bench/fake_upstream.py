@@ -0,0 +1,188 @@
+"""
+Local stand-in for the anime API, the stream API and Discord OAuth.
+
+One threaded HTTP server answers:
+    /anime/...     what BASE_URL serves (spotlight, info, search, genre, ...)
+    /stream/...    what STREAM_URL serves (stream data per episode)
+    /discord/...   the OAuth token exchange and /users/@me
+    /__stats       upstream call counts per endpoint, /__reset clears them
+
+Latency (mean + uniform jitter) and an error rate are injected per request, so
+cache, coalescing and breaker changes can be measured against a slow or flaky
+upstream. Run standalone with:
+    python -m bench.fake_upstream --port 8700 --latency 0.08 --error-rate 0.02
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from bench import fixtures
+
+CATEGORIES = {
+    'spotlight': 1, 'recent-episodes': 2, 'new-releases': 3, 'top-upcoming': 4,
+    'latest-completed': 5, 'movies': 6, 'tv': 7, 'ova': 8, 'ona': 9, 'specials': 10,
+    'recent-added': 11,
+}
+
+
+class FakeUpstream:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, jitter=0.02, error_rate=0.0,
+                 fixtures_dir=None, episodes=24):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.fixtures_dir = fixtures_dir
+        self.episodes = episodes
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._rng = random.Random(42)
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-upstream', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.calls)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+
+    def _count(self, label):
+        with self._lock:
+            self.calls[label] += 1
+
+    def _delay_and_fail(self):
+        """Sleeps the injected latency; returns True if this request should fail."""
+        with self._lock:
+            delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+            fail = self._rng.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    def anime_payload(self, path, query):
+        page = int(query.get('page', ['1'])[0])
+        recorded = fixtures.load_recorded(self.fixtures_dir, path)
+        if path in CATEGORIES:
+            return path, recorded or fixtures.listing(CATEGORIES[path], page=page)
+        if path == 'schedule/today':
+            return 'schedule', recorded or fixtures.schedule()
+        if path == 'info':
+            return 'info', recorded or fixtures.info(query.get('id', [''])[0], self.episodes)
+        if path == 'search-suggestions':
+            return 'search-suggestions', recorded or fixtures.suggestions(query.get('query', [''])[0])
+        if path.startswith('search-suggestions/'):
+            return 'search-suggestions', recorded or fixtures.suggestions(path.split('/', 1)[1])
+        if path.startswith('genre/'):
+            return 'genre', recorded or fixtures.listing(zlib.crc32(path.encode()) % 50, page=page)
+        return 'search', recorded or fixtures.listing(zlib.crc32(path.encode()) % 50, page=page)
+
+    def _handler(self):
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                if urlsplit(self.path).path == '/discord/api/oauth2/token':
+                    upstream._count('discord-token')
+                    if upstream._delay_and_fail():
+                        return self._send(503, {'error': 'injected'})
+                    return self._send(200, {'access_token': f'tok-{random.random()}', 'token_type': 'Bearer'})
+                self._send(404, {'error': 'not found'})
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                path, query = unquote(parts.path), parse_qs(parts.query)
+
+                if path == '/__stats':
+                    return self._send(200, upstream.stats())
+                if path == '/__reset':
+                    upstream.reset()
+                    return self._send(200, {})
+
+                if path == '/discord/api/users/@me':
+                    upstream._count('discord-user')
+                    if upstream._delay_and_fail():
+                        return self._send(503, {'error': 'injected'})
+                    token = self.headers.get('Authorization', '')
+                    uid = str(zlib.crc32(token.encode()) % 50000)
+                    return self._send(200, {
+                        'id': uid, 'username': f'user{uid}', 'global_name': f'User {uid}',
+                        'email': f'user{uid}@example.com', 'avatar': None,
+                    })
+
+                if path.startswith('/anime/'):
+                    label, payload = upstream.anime_payload(path[len('/anime/'):], query)
+                elif path.startswith('/stream/'):
+                    label = 'stream'
+                    payload = fixtures.stream(
+                        path[len('/stream/'):], query.get('ep', ['1'])[0], query.get('category', ['sub'])[0],
+                    )
+                else:
+                    return self._send(404, {'error': 'not found'})
+
+                upstream._count(label)
+                if upstream._delay_and_fail():
+                    return self._send(503, {'error': 'injected'})
+                self._send(200, payload)
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8700)
+    parser.add_argument('--latency', type=float, default=0.05, help='mean injected latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.02, help='uniform +/- jitter (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered 503')
+    parser.add_argument('--fixtures', help='directory of recorded JSON responses')
+    args = parser.parse_args()
+
+    upstream = FakeUpstream(args.host, args.port, args.latency, args.jitter, args.error_rate, args.fixtures)
+    print(f'Fake upstream on {upstream.url}')
+    print(f'  BASE_URL={upstream.url}/anime')
+    print(f'  STREAM_URL={upstream.url}/stream')
+    try:
+        upstream.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
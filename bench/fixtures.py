@@ -0,0 +1,120 @@
+"""
+Consumet-style payloads for the fake upstream.
+
+Each builder returns deterministic JSON shaped like the real BASE_URL/STREAM_URL
+responses our templates and index.js read. A directory of recorded responses
+can be used instead: a file named after the endpoint (slashes replaced by
+'__', e.g. 'schedule__today.json', 'info.json') overrides the generated payload.
+"""
+import json
+import os
+import random
+
+TITLES = [
+    'Naruto Shippuden', 'One Piece', 'Attack on Titan', 'Jujutsu Kaisen', 'Demon Slayer',
+    'Spy x Family', 'Chainsaw Man', 'Frieren Beyond Journeys End', 'Bleach Thousand Year Blood War',
+    'My Hero Academia', 'Solo Leveling', 'Oshi no Ko', 'Blue Lock', 'Vinland Saga', 'Dandadan',
+    'Kaiju No 8', 'Mushoku Tensei', 'Hunter x Hunter', 'Haikyuu', 'Dr Stone',
+]
+GENRES = ['action', 'adventure', 'comedy', 'drama', 'fantasy', 'romance', 'sci-fi', 'slice-of-life']
+
+
+def anime_id(title, n=0):
+    return f"{title.lower().replace(' ', '-')}-{1000 + n}"
+
+
+def card(i):
+    title = f"{TITLES[i % len(TITLES)]}{'' if i < len(TITLES) else f' Season {i // len(TITLES) + 1}'}"
+    return {
+        'id': anime_id(title, i),
+        'title': title,
+        'image': f'https://img.example/{i}.jpg',
+        'banner': f'https://img.example/{i}-banner.jpg',
+        'type': 'TV' if i % 5 else 'Movie',
+        'sub': 12 + i % 13,
+        'dub': i % 3 and 10 + i % 7,
+        'episodes': 12 + i % 13,
+        'releaseDate': str(2010 + i % 15),
+        'subOrDub': 'sub',
+        'description': f'Synopsis for {title}. ' * 8,
+    }
+
+
+def listing(seed=0, count=20, page=1):
+    start = seed * 7 + (page - 1) * count
+    return {
+        'currentPage': page,
+        'hasNextPage': page < 50,
+        'results': [card(start + i) for i in range(count)],
+    }
+
+
+def info(anime, episodes=24):
+    rng = random.Random(anime)
+    base = card(rng.randrange(200))
+    return dict(
+        base,
+        id=anime,
+        japaneseTitle='アニメ',
+        status='Ongoing',
+        season='Fall',
+        duration='24m',
+        malScore='8.5',
+        rating='PG-13',
+        quality='HD',
+        hasDub=True,
+        totalEpisodes=episodes,
+        genres=['', 'Genres: Action, Adventure, Fantasy'],
+        studios=['Studio Example'],
+        producers=['Producer A', 'Producer B'],
+        episodes=[
+            {
+                'id': f'{anime}$episode${i}',
+                'number': i,
+                'title': f'Episode {i}',
+                'isFiller': False,
+                'url': f'https://upstream.example/watch/{anime}?ep={i}',
+            }
+            for i in range(1, episodes + 1)
+        ],
+        relations=[card(rng.randrange(200)) for _ in range(4)],
+        recommendations=[card(rng.randrange(200)) for _ in range(12)],
+        seasons=[],
+    )
+
+
+def schedule():
+    return {'results': [
+        {'id': anime_id(t, i), 'title': t, 'airingTime': f'{10 + i % 12}:00', 'airingEpisode': 5 + i}
+        for i, t in enumerate(TITLES[:12])
+    ]}
+
+
+def suggestions(query):
+    q = query.lower()
+    hits = [card(i) for i in range(len(TITLES) * 3) if q in card(i)['title'].lower()]
+    return {'results': hits[:8]}
+
+
+def stream(episode, ep, category):
+    return {
+        'ok': True,
+        'count': 2,
+        'anime_title': episode.replace('-', ' ').title(),
+        'subtitle': f'Episode {ep} ({category})',
+        'streams': {'sources': [{'url': f'https://cdn.example/{episode}/{ep}/{category}/master.m3u8', 'quality': 'auto'}]},
+        'servers': [
+            {'name': 'Server 1', 'url': f'https://embed.example/1/{episode}/{ep}'},
+            {'name': 'Server 2', 'url': f'https://embed.example/2/{episode}/{ep}'},
+        ],
+    }
+
+
+def load_recorded(fixtures_dir, endpoint):
+    if not fixtures_dir:
+        return None
+    path = os.path.join(fixtures_dir, endpoint.strip('/').replace('/', '__') + '.json')
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
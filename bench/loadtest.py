@@ -0,0 +1,224 @@
+"""
+Scripted load scenarios against the app, backed by bench.fake_upstream.
+
+The Flask app runs in-process on a threaded local server. Its upstreams point
+at the fake upstream, and UserManager is replaced by bench.stub_db unless
+--database-url is given. Each scenario is run by N virtual users, each with
+its own keep-alive session:
+
+    home     GET / then /api/home/feed              (home page hydration)
+    search   /api/search-suggestions/<prefix> per keystroke, then /search
+    binge    /watch/<id>?ep=1..N in order           (next-episode clicks)
+    login    /auth/discord/callback?code=...        (OAuth login storm)
+
+Reported per scenario: throughput, p50/p95/p99 latency, errors, and how many
+upstream calls the fake upstream saw. --budget turns on the upstream budget
+and reports how many calls it refused per scenario. --json writes the results
+and --compare prints the deltas against an earlier run:
+
+    python -m bench.loadtest --users 20 --iterations 10 --latency 0.08 --json after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from bench import fixtures
+from bench.fake_upstream import FakeUpstream
+
+SCENARIOS = ('home', 'search', 'binge', 'login')
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def timed(self, session, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = session.get(url, timeout=30, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.append(elapsed)
+            if not ok:
+                self.errors += 1
+
+
+# --- Scenarios: one iteration of one virtual user ---
+
+def scenario_home(base, session, rec, rng, args):
+    rec.timed(session, f'{base}/')
+    rec.timed(session, f'{base}/api/home/feed')
+
+
+def scenario_search(base, session, rec, rng, args):
+    title = rng.choice(fixtures.TITLES)
+    # A typing burst: one suggestion request per keystroke after the second
+    for i in range(2, min(len(title), 10) + 1):
+        rec.timed(session, f'{base}/api/search-suggestions/{title[:i]}')
+    rec.timed(session, f'{base}/search', params={'q': title})
+
+
+def scenario_binge(base, session, rec, rng, args):
+    anime = fixtures.anime_id(rng.choice(fixtures.TITLES), rng.randrange(args.catalogue))
+    for ep in range(1, args.episodes + 1):
+        rec.timed(session, f'{base}/watch/{anime}', params={'ep': ep})
+        if args.think:
+            time.sleep(args.think)
+
+
+def scenario_login(base, session, rec, rng, args):
+    session.cookies.clear()
+    rec.timed(session, f'{base}/auth/discord/callback', params={'code': str(rng.random())}, allow_redirects=False)
+
+
+def run_scenario(name, base, upstream, args):
+    from services import upstream_budget
+
+    func = globals()[f'scenario_{name}']
+    rec = Recorder()
+    upstream.reset()
+    refused_before = sum(upstream_budget.stats()['refused'].values())
+
+    def user(n):
+        rng = random.Random(args.seed * 1000 + n)
+        with requests.Session() as session:
+            # Each virtual user is its own client to the per-client rate limiter
+            session.headers['X-Forwarded-For'] = f'10.0.{n // 256}.{n % 256}'
+            for _ in range(args.iterations):
+                func(base, session, rec, rng, args)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.users) as pool:
+        list(pool.map(user, range(args.users)))
+    wall = time.perf_counter() - start
+
+    ordered = sorted(rec.latencies)
+    calls = upstream.stats()
+    return {
+        'requests': len(ordered),
+        'errors': rec.errors,
+        'seconds': round(wall, 3),
+        'throughput_rps': round(len(ordered) / wall, 1) if wall else 0.0,
+        'p50_ms': round(percentile(ordered, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(ordered, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(ordered, 0.99) * 1000, 1),
+        'upstream_calls': sum(calls.values()),
+        # Upstream calls the app didn't make because --budget was spent
+        'budget_refused': sum(upstream_budget.stats()['refused'].values()) - refused_before,
+        'upstream_by_endpoint': calls,
+    }
+
+
+def start_app(upstream, args):
+    """Points the app at the fake upstream and serves it on a local threaded server."""
+    os.environ['BASE_URL'] = f'{upstream.url}/anime'
+    os.environ['STREAM_URL'] = f'{upstream.url}/stream'
+    os.environ.setdefault('SECRET_KEY', 'bench')
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    # Every run starts cold; a snapshot left by an earlier run would skew the comparison
+    os.environ.setdefault('CACHE_SNAPSHOT_INTERVAL', '0')
+    os.environ.setdefault('RATE_LIMIT_TRUST_FORWARDED', '1')
+    # Virtual users type without pauses; keep the suggestion limit out of the latency numbers
+    os.environ.setdefault('RATE_LIMIT_SUGGEST', '50,100')
+    if args.budget is not None:
+        os.environ['UPSTREAM_BUDGET_RATE'] = str(args.budget)
+
+    import database
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+        database.DATABASE_URL = args.database_url
+    else:
+        from bench.stub_db import StubUserManager
+        database.UserManager = StubUserManager
+
+    import app as shiro
+    shiro.TOKEN_URL = f'{upstream.url}/discord/api/oauth2/token'
+    shiro.USER_INFO_URL = f'{upstream.url}/discord/api/users/@me'
+
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, shiro.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='shiro-bench', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def print_report(results, baseline=None):
+    cols = ('requests', 'errors', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'upstream_calls', 'budget_refused')
+    print(f"{'scenario':<10}" + ''.join(f'{c:>16}' for c in cols))
+    for name, row in results.items():
+        print(f'{name:<10}' + ''.join(f'{row.get(c, "-"):>16}' for c in cols))
+        before = (baseline or {}).get(name)
+        if before:
+            deltas = []
+            for c in cols:
+                if before.get(c):
+                    deltas.append(f'{(row[c] - before[c]) / before[c] * 100:+15.1f}%')
+                else:
+                    deltas.append(f'{"-":>16}')
+            print(f"{'  vs base':<10}" + ''.join(deltas))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help='repeatable; default: all')
+    parser.add_argument('--users', type=int, default=20, help='concurrent virtual users')
+    parser.add_argument('--iterations', type=int, default=10, help='scenario iterations per user')
+    parser.add_argument('--episodes', type=int, default=6, help='episodes watched per binge iteration')
+    parser.add_argument('--catalogue', type=int, default=40, help='distinct anime ids per title in binge')
+    parser.add_argument('--think', type=float, default=0.0, help='pause between binge episodes (s)')
+    parser.add_argument('--latency', type=float, default=0.08, help='fake upstream mean latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.04)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--budget', type=float, help='upstream requests/s per process (UPSTREAM_BUDGET_RATE); off by default')
+    parser.add_argument('--fixtures', help='directory of recorded upstream JSON')
+    parser.add_argument('--database-url', help='use a real (local) Postgres instead of the stub')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--compare', help='earlier --json output to diff against')
+    args = parser.parse_args(argv)
+
+    upstream = FakeUpstream(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                            fixtures_dir=args.fixtures).start()
+    server, base = start_app(upstream, args)
+
+    results = {}
+    try:
+        for name in args.scenario or SCENARIOS:
+            results[name] = run_scenario(name, base, upstream, args)
+    finally:
+        server.shutdown()
+        upstream.stop()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f).get('results')
+    print_report(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+"""
+In-memory stand-in for database.UserManager, so the login scenario can run
+without Postgres. Query latency is simulated with a sleep.
+"""
+import itertools
+import threading
+import time
+
+
+class StubUserManager:
+    def __init__(self, query_latency=0.005):
+        self.query_latency = query_latency
+        self._users = {}  # uid -> row
+        self._by_provider = {}  # (id column, provider id) -> uid
+        self._ids = itertools.count(1)
+        self._progress = {}  # (uid, anime id, episode) -> row
+        self._lock = threading.Lock()
+        self.queries = 0
+
+    def _query(self):
+        self.queries += 1
+        if self.query_latency:
+            time.sleep(self.query_latency)
+
+    def sync_oauth_user(self, provider, provider_id, display_name, username, email, avatar):
+        self._query()
+        id_col = 'google_id' if provider == 'google' else 'discord_id'
+        with self._lock:
+            uid = self._by_provider.get((id_col, provider_id))
+            if uid is None:
+                uid = next(self._ids)
+                self._by_provider[(id_col, provider_id)] = uid
+                self._users[uid] = {'uid': uid, id_col: provider_id, 'original_provider': provider}
+            row = self._users[uid]
+            row.update(display_name=display_name, email=email, avatar=avatar, username=username, last_login=time.time())
+            return dict(row)
+
+    def get_user_by_id(self, uid):
+        self._query()
+        with self._lock:
+            row = self._users.get(uid)
+            return dict(row) if row else None
+
+    def record_progress(self, uid, anime_id, episode, position, duration=None, title=None, image=None):
+        with self._lock:
+            self._progress[(str(uid), str(anime_id), str(episode))] = {
+                'anime_id': str(anime_id), 'episode': str(episode), 'title': title, 'image': image,
+                'position': float(position), 'duration': duration, 'updated_at': time.time(),
+            }
+
+    def get_watch_history(self, uid, limit=20):
+        self._query()
+        with self._lock:
+            rows = [dict(row) for key, row in self._progress.items() if key[0] == str(uid)]
+        return sorted(rows, key=lambda r: r['updated_at'], reverse=True)[:limit]
+
+    def flush(self):
+        return 0
+
+    def close(self):
+        pass
@@ -0,0 +1,17 @@
+import threading
+
+# app, services and database all read settings from the environment at import
+# time. Each of them calls load_env() first; only the first call parses .env.
+
+_loaded = False
+_lock = threading.Lock()
+
+def load_env():
+    global _loaded
+    if _loaded:
+        return
+    with _lock:
+        if not _loaded:
+            from dotenv import load_dotenv
+            load_dotenv()
+            _loaded = True
@@ -1,79 +1,713 @@
 import os
+import time
+import uuid
+import atexit
+import select
+import logging
+import threading
+from datetime import datetime, timezone
 import psycopg2
-from psycopg2.extras import RealDictCursor
-from psycopg2.pool import SimpleConnectionPool
+from cachetools import TTLCache
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError
 from contextlib import contextmanager
-from dotenv import load_dotenv
+from metrics import REGISTRY, gauge, histogram
+from config import load_env
 
-load_dotenv()
+load_env()
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+DB_POOL_WAIT = histogram(
+    'shiro_db_pool_wait_seconds', 'Time spent checking a connection out of the pool',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+DB_CONNECTIONS_IN_USE = gauge('shiro_db_connections_in_use', 'Pooled connections currently checked out')
+
+log = logging.getLogger('shiro.database')
+
+# Login write-behind: updates for already-known users are buffered and upserted in batches
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', 5))
+USER_FLUSH_BATCH = int(os.getenv('USER_FLUSH_BATCH', 500))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 5000))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 600))
+HISTORY_CACHE_TTL = int(os.getenv('HISTORY_CACHE_TTL', 300))
+# Each flush NOTIFYs the uids it wrote here; every worker LISTENs and drops
+# those rows from its user cache. Postgres caps a payload at 8000 bytes.
+USER_SYNC_CHANNEL = 'shiro_user_sync'
+USER_SYNC_PAYLOAD_MAX = 7000
+
+USER_FLUSHES = histogram(
+    'shiro_db_user_flush_rows', 'Rows written per batched user upsert',
+    buckets=(1, 5, 10, 50, 100, 500, 1000),
+)
+
+# provider -> (id column, username column, email column, avatar column)
+PROVIDER_COLUMNS = {
+    'google': ('google_id', 'display_name', 'google_email', 'google_avatar'),  # Google doesn't usually have a separate 'username'
+    'discord': ('discord_id', 'discord_username', 'discord_email', 'discord_avatar'),
+}
+
+def provider_columns(provider):
+    return PROVIDER_COLUMNS.get(provider, PROVIDER_COLUMNS['discord'])
+
+# Watch progress: player heartbeats are merged per user/episode and upserted in batches
+PROGRESS_FLUSH_INTERVAL = float(os.getenv('PROGRESS_FLUSH_INTERVAL', 10))
+PROGRESS_FLUSH_BATCH = int(os.getenv('PROGRESS_FLUSH_BATCH', 5000))
+# While flushes fail the buffer keeps only the most recent heartbeats
+PROGRESS_MAX_PENDING = int(os.getenv('PROGRESS_MAX_PENDING', 50000))
+PROGRESS_HISTORY_LIMIT = 20
+
+PROGRESS_FLUSHES = histogram(
+    'shiro_db_progress_flush_rows', 'Rows written per batched watch-progress upsert',
+    buckets=(1, 10, 100, 500, 1000, 5000, 10000),
+)
+
+# Applied by `python database.py` at deploy time, and by the flusher thread
+# before its first progress write; never from a request.
+# uid is stored as text so this table doesn't depend on users.uid's column type.
+# History reads are "latest N for one user", which the (uid, updated_at DESC)
+# index answers with a short forward scan and no sort.
+PROGRESS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS watch_progress (
+        uid TEXT NOT NULL,
+        anime_id TEXT NOT NULL,
+        episode TEXT NOT NULL,
+        title TEXT,
+        image TEXT,
+        position REAL NOT NULL DEFAULT 0,
+        duration REAL,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (uid, anime_id, episode)
+    );
+    CREATE INDEX IF NOT EXISTS watch_progress_uid_recent
+        ON watch_progress (uid, updated_at DESC);
+"""
+
+
+class PoolTimeout(PoolError):
+    """No connection was returned to the pool within the wait timeout."""
+
+
+class ConnectionPool:
+    """
+    Thread-safe, bounded psycopg2 pool.
+
+    Connections are opened lazily, up to maxconn. When all of them are checked
+    out, getconn() waits up to `timeout` seconds for one to come back instead of
+    failing at once. A connection that sat idle longer than `check_after` is
+    pinged before it is handed out, and one older than `max_lifetime` is
+    replaced, so connections killed by Neon's idle suspend are never given to
+    a request. Opening a connection is retried with backoff to ride out a
+    serverless cold start.
+    """
+
+    def __init__(self, dsn, maxconn=10, timeout=10, check_after=30, max_lifetime=1800,
+                 connect_timeout=10, connect_retries=3):
+        self.dsn = dsn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_lifetime = max_lifetime
+        self.connect_timeout = connect_timeout
+        self.connect_retries = connect_retries
+        self._idle = []  # (conn, created_at, last_used) — LIFO keeps hot connections hot
+        self._created = {}  # id(conn) -> created_at, for checked-out connections
+        self._size = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self.recycled = self.timeouts = 0
+
+    def _connect(self):
+        delay = 0.5
+        for attempt in range(1, self.connect_retries + 1):
+            try:
+                return psycopg2.connect(self.dsn, connect_timeout=self.connect_timeout)
+            except psycopg2.OperationalError as e:
+                if attempt == self.connect_retries:
+                    raise
+                log.warning("Database connect failed (attempt %s/%s): %s", attempt, self.connect_retries, e)
+                time.sleep(delay)
+                delay *= 2
+
+    def _usable(self, conn, created_at, last_used):
+        now = time.monotonic()
+        if conn.closed or now - created_at > self.max_lifetime:
+            return False
+        if now - last_used < self.check_after:
+            return True
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self.recycled += 1
+            self._cond.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+                if self._idle:
+                    conn, created_at, last_used = self._idle.pop()
+                    opening = False
+                elif self._size < self.maxconn:
+                    self._size += 1
+                    opening = True
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self._cond.wait(remaining):
+                        if not self._idle and self._size >= self.maxconn:
+                            self.timeouts += 1
+                            raise PoolTimeout(f"no database connection available within {self.timeout}s")
+                    continue
+
+            # Network round trips happen outside the lock
+            if opening:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                created_at = time.monotonic()
+            elif not self._usable(conn, created_at, last_used):
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._created[id(conn)] = created_at
+            return conn
+
+    def putconn(self, conn, close=False):
+        with self._cond:
+            created_at = self._created.pop(id(conn), time.monotonic())
+            broken = close or self._closed or conn.closed
+            if not broken:
+                self._idle.append((conn, created_at, time.monotonic()))
+                self._cond.notify()
+                return
+        self._discard(conn)
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max': self.maxconn,
+                'recycled': self.recycled,
+                'timeouts': self.timeouts,
+            }
+
 class UserManager:
     def __init__(self):
-        # Create a connection pool
-        # minconn=1, maxconn=10 (adjust as needed)
-        self.pool = SimpleConnectionPool(
-            minconn=1, 
-            maxconn=10, 
-            dsn=DATABASE_URL
-        )
+        # The pool (and its first connection) is created on first use,
+        # so importing app.py doesn't open a connection on a cold start
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+        # Read-through cache for get_user_by_id, and (provider, provider id) -> uid
+        # for users this process has already synced, which is what lets a repeat
+        # login skip the synchronous write
+        self._users = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        self._known = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+        self._pending = {}  # (provider, provider id) -> (uid, row values); latest login wins
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._flusher = None
+        self._flush_lock = threading.Lock()
+        self.cache_hits = self.cache_misses = 0
+        self.buffered = self.flushed = 0
+
+        # Cross-worker invalidation of _users (see _run_listener)
+        self._instance = uuid.uuid4().hex[:12]  # tags our own NOTIFYs so we skip them
+        self._listener = None
+        self._users_generation = 0  # bumped per invalidation, so a read that raced one isn't cached
+        self.invalidated = 0
+
+        self._progress = {}  # (uid, anime id, episode) -> latest heartbeat row
+        self._progress_lock = threading.Lock()
+        # (uid, limit) -> saved history rows; unflushed heartbeats are merged on read
+        self._history = TTLCache(maxsize=USER_CACHE_SIZE, ttl=HISTORY_CACHE_TTL)
+        self._progress_generation = 0  # bumped per flush, so a read that raced one isn't cached
+        self._schema_ready = False
+        self.heartbeats = self.progress_flushed = self.progress_dropped = 0
+
+        REGISTRY.add_collector(self.collect_metrics)
+        REGISTRY.add_collector(self.collect_user_metrics)
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(
+                        DATABASE_URL,
+                        maxconn=int(os.getenv('DB_POOL_MAX', 10)),
+                        timeout=float(os.getenv('DB_POOL_TIMEOUT', 10)),
+                        check_after=float(os.getenv('DB_CHECK_AFTER', 30)),
+                        max_lifetime=float(os.getenv('DB_MAX_LIFETIME', 1800)),
+                    )
+        return self._pool
 
     @contextmanager
     def get_cursor(self):
+        start = time.perf_counter()
         conn = self.pool.getconn()
+        DB_POOL_WAIT.observe(time.perf_counter() - start)
+        DB_CONNECTIONS_IN_USE.inc()
         conn.autocommit = True
+        broken = False
         try:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 yield cur
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Connection died mid-query; don't hand it to the next request
+            broken = True
+            raise
         finally:
-            self.pool.putconn(conn)
+            self.pool.putconn(conn, close=broken)
+            DB_CONNECTIONS_IN_USE.dec()
 
     def sync_oauth_user(self, provider, provider_id, display_name, username, email, avatar):
         """
         Syncs data with the table containing separate google/discord columns.
+
+        Only a brand-new user is written synchronously, so the row exists before
+        the redirect. Logins by existing users only refresh last_login and profile
+        fields, so they are buffered and flushed in batches; the returned row
+        already reflects the new values. Whether a user exists is known from
+        earlier logins in this process, or else from one indexed SELECT.
         """
-        # Map the provider to the correct table columns
-        if provider == "google":
-            id_col = "google_id"
-            email_col = "google_email"
-            avatar_col = "google_avatar"
-            user_col = "display_name" # Google doesn't usually have a separate 'username'
-        else:
-            id_col = "discord_id"
-            email_col = "discord_email"
-            avatar_col = "discord_avatar"
-            user_col = "discord_username"
+        self._ensure_listener()
+        key = (provider, str(provider_id))
+        login_at = datetime.now(timezone.utc)
+        values = (provider_id, provider, display_name, username, email, avatar, login_at)
+
+        with self._lock:
+            uid = self._known.get(key)
+        if uid is None:
+            existing = self._find_user(provider, provider_id)
+            if existing is None:
+                row = dict(self._upsert(provider, [values], returning=True)[0])
+                with self._lock:
+                    self._known[key] = row['uid']
+                    self._users[row['uid']] = row
+                return dict(row)
+            uid = existing['uid']
+            with self._lock:
+                self._known[key] = uid
+                self._users.setdefault(uid, existing)
+
+        with self._lock:
+            self._pending[key] = (uid, values)
+            self.buffered += 1
+            pending = len(self._pending)
+            row = self._users.get(uid)
+            if row is not None:
+                row = self._users[uid] = self._apply(row, provider, values)
+        self._ensure_flusher()
+        if pending >= USER_FLUSH_BATCH:
+            self._wake.set()
+        if row is not None:
+            return dict(row)
+        # Known user whose cached row expired: read it back, buffered login applied
+        return self.get_user_by_id(uid)
+
+    def _find_user(self, provider, provider_id):
+        # The provider id column is the upsert's conflict target, so it's unique and indexed
+        id_col = provider_columns(provider)[0]
+        with self.get_cursor() as cur:
+            cur.execute(f"SELECT * FROM users WHERE {id_col} = %s;", (provider_id,))
+            row = cur.fetchone()
+        return dict(row) if row is not None else None
+
+    def get_user_by_id(self, uid):
+        self._ensure_listener()
+        with self._lock:
+            row = self._users.get(uid)
+            if row is not None:
+                self.cache_hits += 1
+                return dict(row)
+            self.cache_misses += 1
+            generation = self._users_generation
+
+        sql = "SELECT * FROM users WHERE uid = %s;"
+        with self.get_cursor() as cur:
+            cur.execute(sql, (uid,))
+            row = cur.fetchone()
+        if row is None:
+            return None
+
+        row = dict(row)
+        with self._lock:
+            # A login for this user may still be sitting in the buffer
+            for (provider, _), (pending_uid, values) in self._pending.items():
+                if pending_uid == uid:
+                    row = self._apply(row, provider, values)
+            if generation == self._users_generation:
+                self._users[uid] = row
+        return dict(row)
+
+    @staticmethod
+    def _apply(row, provider, values):
+        _, _, display_name, username, email, avatar, login_at = values
+        _, user_col, email_col, avatar_col = provider_columns(provider)
+        row = dict(row)
+        row.update({
+            'display_name': display_name,
+            user_col: username,
+            email_col: email,
+            avatar_col: avatar,
+            'last_login': login_at,
+        })
+        return row
+
+    def _upsert(self, provider, rows, returning=False):
+        id_col, user_col, email_col, avatar_col = provider_columns(provider)
 
         # We use 'original_provider' for the first-time insert
         # We use EXCLUDED to update profile info on every login
         sql = f"""
             INSERT INTO users (
-                {id_col}, original_provider, display_name, 
-                {user_col}, {email_col}, {avatar_col}
+                {id_col}, original_provider, display_name,
+                {user_col}, {email_col}, {avatar_col}, last_login
             )
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT ({id_col}) 
-            DO UPDATE SET 
-                last_login = CURRENT_TIMESTAMP,
+            VALUES %s
+            ON CONFLICT ({id_col})
+            DO UPDATE SET
+                last_login = EXCLUDED.last_login,
                 display_name = EXCLUDED.display_name,
                 {user_col} = EXCLUDED.{user_col},
                 {email_col} = EXCLUDED.{email_col},
                 {avatar_col} = EXCLUDED.{avatar_col}
-            RETURNING *;
+            {'RETURNING *' if returning else ''};
         """
-        
-        params = (provider_id, provider, display_name, username, email, avatar)
-        
+
         with self.get_cursor() as cur:
-            cur.execute(sql, params)
-            return cur.fetchone()
+            return execute_values(cur, sql, rows, page_size=len(rows), fetch=returning)
 
-    def get_user_by_id(self, uid):
-        sql = "SELECT * FROM users WHERE uid = %s;"
+    def _ensure_flusher(self):
+        # Started on the first buffered write, in the serving process
+        if self._flusher is not None:
+            return
+        with self._flush_lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run_flusher, name='user-sync-flusher', daemon=True)
+                self._flusher.start()
+                atexit.register(self.close)
+
+    def _run_flusher(self):
+        # One thread drains both write-behind buffers; each keeps its own cadence
+        next_progress = time.monotonic() + PROGRESS_FLUSH_INTERVAL
+        while True:
+            self._wake.wait(min(USER_FLUSH_INTERVAL, max(0, next_progress - time.monotonic())))
+            self._wake.clear()
+            try:
+                self._flush_users()
+            except Exception as e:
+                log.warning("User sync flush failed, will retry: %s", e)
+            if time.monotonic() >= next_progress or len(self._progress) >= PROGRESS_FLUSH_BATCH:
+                next_progress = time.monotonic() + PROGRESS_FLUSH_INTERVAL
+                try:
+                    self._flush_progress()
+                except Exception as e:
+                    log.warning("Watch progress flush failed, will retry: %s", e)
+
+    def flush(self):
+        """Writes everything buffered; called by the flusher thread and on shutdown."""
+        return self._flush_users() + self._flush_progress()
+
+    def _flush_users(self):
+        """Writes buffered logins in one multi-row upsert per provider."""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+
+            by_provider = {}
+            for (provider, _), (uid, values) in batch.items():
+                by_provider.setdefault(provider, []).append((uid, values))
+
+            written = 0
+            try:
+                for provider, entries in by_provider.items():
+                    self._upsert(provider, [values for _, values in entries])
+                    written += len(entries)
+            except Exception:
+                with self._lock:
+                    # Put back whatever didn't land, unless a newer login replaced it
+                    for key, entry in batch.items():
+                        self._pending.setdefault(key, entry)
+                raise
+            finally:
+                if written:
+                    USER_FLUSHES.observe(written)
+
+            # Our cached rows already carry the values just written; other workers' don't
+            with self._lock:
+                self.flushed += written
+            try:
+                self._notify_user_sync({uid for uid, _ in batch.values()})
+            except Exception as e:
+                log.warning("Couldn't notify other workers of %s synced users: %s", written, e)
+            return written
+
+    def _notify_user_sync(self, uids):
+        chunks, chunk = [], []
+        size = len(self._instance) + 1
+        for uid in map(str, uids):
+            if chunk and size + len(uid) + 1 > USER_SYNC_PAYLOAD_MAX:
+                chunks.append(chunk)
+                chunk, size = [], len(self._instance) + 1
+            chunk.append(uid)
+            size += len(uid) + 1
+        if chunk:
+            chunks.append(chunk)
         with self.get_cursor() as cur:
-            cur.execute(sql, (uid,))
-            return cur.fetchone()
+            for chunk in chunks:
+                cur.execute("SELECT pg_notify(%s, %s);", (USER_SYNC_CHANNEL, f"{self._instance}:{','.join(chunk)}"))
+
+    def _ensure_listener(self):
+        # Started once this process caches user rows, in the serving process
+        if self._listener is not None or not DATABASE_URL:
+            return
+        with self._flush_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._run_listener, name='user-sync-listener', daemon=True)
+                self._listener.start()
+
+    def _run_listener(self):
+        """Drops cached user rows that another worker's flush just wrote."""
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL, connect_timeout=10)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {USER_SYNC_CHANNEL};")
+                # Whatever was flushed while we weren't listening is unknown
+                self._invalidate_users(None)
+                while True:
+                    if select.select([conn], [], [], 60) == ([], [], []):
+                        # Idle; make sure the connection is still there
+                        with conn.cursor() as cur:
+                            cur.execute("SELECT 1;")
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        instance, _, uids = conn.notifies.pop(0).payload.partition(':')
+                        if instance != self._instance:
+                            self._invalidate_users(uids.split(','))
+            except Exception as e:
+                log.warning("User sync listener disconnected, reconnecting: %s", e)
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except psycopg2.Error:
+                        pass
+
+    def _invalidate_users(self, uids):
+        """Drops the given uids (all rows if None) from the user cache."""
+        with self._lock:
+            self._users_generation += 1
+            if uids is None:
+                self.invalidated += len(self._users)
+                self._users.clear()
+                return
+            by_str = {str(uid): uid for uid in self._users.keys()}
+            for uid in uids:
+                if uid in by_str:
+                    del self._users[by_str[uid]]
+                    self.invalidated += 1
+
+    def migrate(self):
+        """Creates the tables this module owns; safe to run repeatedly."""
+        with self.get_cursor() as cur:
+            cur.execute(PROGRESS_SCHEMA)
+        self._schema_ready = True
+
+    def _ensure_progress_schema(self):
+        if not self._schema_ready:
+            self.migrate()
+
+    def record_progress(self, uid, anime_id, episode, position, duration=None, title=None, image=None):
+        """
+        Records a player heartbeat. Only the latest heartbeat per user/episode is
+        kept in memory until the next flush, so a viewer costs one row per
+        PROGRESS_FLUSH_INTERVAL no matter how often the player reports.
+        """
+        key = (str(uid), str(anime_id), str(episode))
+        row = key + (title, image, float(position), duration, datetime.now(timezone.utc))
+        with self._progress_lock:
+            # Re-inserted so the buffer stays ordered oldest heartbeat first
+            self._progress.pop(key, None)
+            self._progress[key] = row
+            self.heartbeats += 1
+            self._trim_progress()
+            pending = len(self._progress)
+        self._ensure_flusher()
+        if pending >= PROGRESS_FLUSH_BATCH:
+            self._wake.set()
+
+    def _trim_progress(self):
+        # Caller holds _progress_lock
+        while len(self._progress) > PROGRESS_MAX_PENDING:
+            del self._progress[next(iter(self._progress))]
+            self.progress_dropped += 1
+
+    def _flush_progress(self):
+        with self._progress_lock:
+            batch, self._progress = self._progress, {}
+        if not batch:
+            return 0
+
+        # Older rows never overwrite newer ones, e.g. from another worker's buffer
+        sql = """
+            INSERT INTO watch_progress (uid, anime_id, episode, title, image, position, duration, updated_at)
+            VALUES %s
+            ON CONFLICT (uid, anime_id, episode)
+            DO UPDATE SET
+                title = COALESCE(EXCLUDED.title, watch_progress.title),
+                image = COALESCE(EXCLUDED.image, watch_progress.image),
+                position = EXCLUDED.position,
+                duration = COALESCE(EXCLUDED.duration, watch_progress.duration),
+                updated_at = EXCLUDED.updated_at
+            WHERE watch_progress.updated_at < EXCLUDED.updated_at;
+        """
+        try:
+            self._ensure_progress_schema()
+            with self.get_cursor() as cur:
+                execute_values(cur, sql, list(batch.values()), page_size=1000)
+        except Exception:
+            with self._progress_lock:
+                # Put the batch back ahead of newer heartbeats, which win on conflict
+                batch.update(self._progress)
+                self._progress = batch
+                self._trim_progress()
+            raise
+
+        PROGRESS_FLUSHES.observe(len(batch))
+        uids = {key[0] for key in batch}
+        with self._progress_lock:
+            self.progress_flushed += len(batch)
+            # Flushed heartbeats are no longer merged from the buffer; re-read those histories
+            self._progress_generation += 1
+            for cached in [k for k in self._history if k[0] in uids]:
+                self._history.pop(cached, None)
+        return len(batch)
+
+    def get_watch_history(self, uid, limit=PROGRESS_HISTORY_LIMIT):
+        """
+        Most recently watched episodes for a user, newest first, including
+        unflushed heartbeats. Saved rows are cached per user until this process
+        flushes progress for them or HISTORY_CACHE_TTL passes.
+        """
+        uid = str(uid)
+        with self._progress_lock:
+            saved = self._history.get((uid, limit))
+            generation = self._progress_generation
+        if saved is None:
+            sql = """
+                SELECT anime_id, episode, title, image, position, duration, updated_at
+                FROM watch_progress
+                WHERE uid = %s
+                ORDER BY updated_at DESC
+                LIMIT %s;
+            """
+            try:
+                with self.get_cursor() as cur:
+                    cur.execute(sql, (uid, limit))
+                    saved = [dict(r) for r in cur.fetchall()]
+            except psycopg2.errors.UndefinedTable:
+                # Not migrated yet and nothing flushed: only buffered heartbeats exist
+                saved, generation = [], None
+            with self._progress_lock:
+                if generation == self._progress_generation:
+                    self._history[(uid, limit)] = saved
+        rows = {(r['anime_id'], r['episode']): dict(r) for r in saved}
+
+        with self._progress_lock:
+            pending = [row for key, row in self._progress.items() if key[0] == uid]
+        for _, anime_id, episode, title, image, position, duration, updated_at in pending:
+            saved = rows.get((anime_id, episode), {})
+            rows[(anime_id, episode)] = {
+                'anime_id': anime_id,
+                'episode': episode,
+                'title': title or saved.get('title'),
+                'image': image or saved.get('image'),
+                'position': position,
+                'duration': duration or saved.get('duration'),
+                'updated_at': updated_at,
+            }
+        return sorted(rows.values(), key=lambda r: r['updated_at'], reverse=True)[:limit]
+
+    def collect_metrics(self):
+        if self._pool is None:
+            return
+        stats = self._pool.stats()
+        yield ('shiro_db_pool_connections', 'gauge', 'Open pooled connections', {'state': 'idle'}, stats['idle'])
+        yield ('shiro_db_pool_connections', 'gauge', 'Open pooled connections', {'state': 'in_use'}, stats['in_use'])
+        yield ('shiro_db_pool_max', 'gauge', 'Pool size limit', {}, stats['max'])
+        yield ('shiro_db_pool_recycled_total', 'counter', 'Connections closed as dead, stale or broken', {}, stats['recycled'])
+        yield ('shiro_db_pool_timeouts_total', 'counter', 'Checkouts that gave up waiting for a connection', {}, stats['timeouts'])
+
+    def collect_user_metrics(self):
+        with self._lock:
+            pending = len(self._pending)
+        yield ('shiro_db_user_cache_total', 'counter', 'get_user_by_id lookups by result', {'result': 'hit'}, self.cache_hits)
+        yield ('shiro_db_user_cache_total', 'counter', 'get_user_by_id lookups by result', {'result': 'miss'}, self.cache_misses)
+        yield ('shiro_db_user_sync_buffered_total', 'counter', 'Logins deferred to the write-behind buffer', {}, self.buffered)
+        yield ('shiro_db_user_sync_flushed_total', 'counter', 'Buffered logins written to the database', {}, self.flushed)
+        yield ('shiro_db_user_cache_invalidated_total', 'counter', 'Cached user rows dropped after another worker synced them', {}, self.invalidated)
+        yield ('shiro_db_user_sync_pending', 'gauge', 'Logins waiting to be flushed', {}, pending)
+        yield ('shiro_db_progress_heartbeats_total', 'counter', 'Watch-progress heartbeats received', {}, self.heartbeats)
+        yield ('shiro_db_progress_flushed_total', 'counter', 'Watch-progress rows written to the database', {}, self.progress_flushed)
+        yield ('shiro_db_progress_pending', 'gauge', 'Watch-progress rows waiting to be flushed', {}, len(self._progress))
+        yield ('shiro_db_progress_dropped_total', 'counter', 'Buffered watch-progress rows dropped to cap the buffer', {}, self.progress_dropped)
 
     def close(self):
-        if hasattr(self, 'pool') and self.pool:
-            self.pool.closeall()
\ No newline at end of file
+        if self._pending or self._progress:
+            try:
+                self.flush()
+            except Exception as e:
+                log.warning("Dropping %s buffered user syncs and %s progress rows: %s",
+                            len(self._pending), len(self._progress), e)
+        if self._pool is not None:
+            self._pool.closeall()
+
+
+if __name__ == '__main__':
+    # Deploy-time migration: python database.py
+    manager = UserManager()
+    manager.migrate()
+    manager.close()
+    print('watch_progress schema is up to date')
@@ -1,15 +1,618 @@
 import os
-import requests
-from dotenv import load_dotenv
-from cachetools import TTLCache, cached
+import json
+import time
+import zlib
+import gzip
+import hashlib
+import re
+import heapq
+import bisect
+import atexit
+import struct
+import tempfile
+import threading
+import logging
+import functools
+from collections import deque
+from contextlib import contextmanager
+from collections.abc import MutableMapping, Sequence
+from concurrent.futures import ThreadPoolExecutor, wait
+
+try:
+    import brotli
+except ImportError:  # optional, gzip is always available
+    brotli = None
+from cachetools import Cache, LRUCache, LFUCache, TTLCache
 from cachetools.keys import hashkey
+from metrics import REGISTRY, counter, histogram, log_sampled
+from config import load_env
+
+load_env()
+log = logging.getLogger('shiro.services')
+
+UPSTREAM_LATENCY = histogram(
+    'shiro_upstream_request_seconds', 'Upstream API request latency', ('upstream', 'endpoint'),
+)
+UPSTREAM_REQUESTS = counter(
+    'shiro_upstream_requests_total', 'Upstream API requests by outcome (ok, error, rejected)',
+    ('upstream', 'endpoint', 'outcome'),
+)
+
+# Category pages we request by name; anything else under BASE_URL is a free-text search
+CATEGORY_ENDPOINTS = {
+    'movies', 'tv', 'ova', 'ona', 'specials', 'recent-episodes', 'recent-added',
+    'new-releases', 'latest-completed', 'spotlight', 'top-upcoming', 'schedule/today',
+}
+
+def endpoint_label(upstream, endpoint):
+    """Bounded metric label for an upstream path (ids and queries are stripped)."""
+    if upstream == 'stream':
+        return 'stream'
+    if endpoint in CATEGORY_ENDPOINTS or endpoint in ('info', 'search-suggestions'):
+        return endpoint
+    if endpoint.startswith('search-suggestions/'):
+        return 'search-suggestions'
+    if endpoint.startswith('genre/'):
+        return 'genre'
+    return 'search'
+
+class JSONSerializer:
+    """
+    Serializer hook for shared cache backends.
+    Upstream payloads are plain JSON, so compact JSON plus zlib round-trips them
+    losslessly at a fraction of the size of the pickled dicts.
+    """
+
+    def __init__(self, compress_level=6):
+        self.compress_level = compress_level
+
+    def dumps(self, value):
+        raw = json.dumps(value, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+        return zlib.compress(raw, self.compress_level) if self.compress_level else raw
+
+    def loads(self, data):
+        if self.compress_level:
+            data = zlib.decompress(data)
+        return json.loads(data)
+
+
+class SQLiteCache(MutableMapping):
+    """
+    Cache backend shared by every worker process on the host.
+    Any MutableMapping that raises KeyError on a miss can sit under @cached;
+    this one keeps entries in a single SQLite file (WAL mode) so a fill made
+    by one Gunicorn worker is a hit for all the others.
+
+    Writes are write-behind: set() queues the value and a background thread
+    serializes and commits the queue in one transaction every flush_interval,
+    and prunes every prune_interval, so no caller waits on the disk for a fill.
+    Reads see this process's queued writes.
+    """
+
+    def __init__(self, path, ttl=300, maxsize=5000, serializer=None, flush_interval=0.5, prune_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.serializer = serializer or JSONSerializer()
+        self.flush_interval = flush_interval
+        self.prune_interval = prune_interval
+        self._local = threading.local()
+        self._pending = {}  # stored key -> (value, expires), or None for a delete; latest wins
+        self._pending_lock = threading.Lock()
+        self._writer = None
+        self._last_prune = time.monotonic()
+        with self._conn() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)")
+
+    def _conn(self):
+        # sqlite3 connections can't be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _key(key):
+        return repr(tuple(key)) if isinstance(key, tuple) else repr(key)
+
+    def __getitem__(self, key):
+        return self.get_with_expiry(key)[0]
+
+    def get_with_expiry(self, key):
+        """(value, expires as wall-clock time); raises KeyError on a miss."""
+        stored, now = self._key(key), time.time()
+        with self._pending_lock:
+            queued = self._pending.get(stored, False)
+        if queued is None:
+            raise KeyError(key)
+        if queued and queued[1] > now:
+            return queued
+        row = self._conn().execute(
+            "SELECT value, expires FROM cache WHERE key = ? AND expires > ?", (stored, now)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self.serializer.loads(row[0]), row[1]
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        with self._pending_lock:
+            self._pending[self._key(key)] = (value, time.time() + (ttl or self.ttl))
+        self._ensure_writer()
+
+    def discard(self, key):
+        """Queues a delete; unlike del, doesn't touch the disk or report whether the key existed."""
+        with self._pending_lock:
+            self._pending[self._key(key)] = None
+        self._ensure_writer()
+
+    def __delitem__(self, key):
+        stored = self._key(key)
+        with self._pending_lock:
+            queued = self._pending.pop(stored, None)
+        cur = self._conn().execute("DELETE FROM cache WHERE key = ?", (stored,))
+        if cur.rowcount == 0 and not queued:
+            raise KeyError(key)
+
+    def _ensure_writer(self):
+        # Started on the first write, in the serving process
+        if self._writer is not None:
+            return
+        with self._pending_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run_writer, name='shared-cache-writer', daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _run_writer(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if time.monotonic() - self._last_prune >= self.prune_interval:
+                    self._last_prune = time.monotonic()
+                    self.prune()
+            except Exception as e:
+                log.warning("Shared cache write failed: %s", e)
+
+    def flush(self):
+        """Commits queued writes and deletes in one transaction; returns how many were applied."""
+        with self._pending_lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        rows, deletes = [], []
+        for stored, queued in batch.items():
+            if queued is None:
+                deletes.append((stored,))
+                continue
+            try:
+                rows.append((stored, self.serializer.dumps(queued[0]), queued[1]))
+            except (TypeError, ValueError):
+                continue
+        conn = self._conn()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)", rows)
+            conn.executemany("DELETE FROM cache WHERE key = ?", deletes)
+            conn.execute("COMMIT")
+        except Exception:
+            # It's a cache: the batch is dropped, not retried
+            conn.execute("ROLLBACK")
+            raise
+        return len(rows) + len(deletes)
+
+    def __iter__(self):
+        rows = self._conn().execute("SELECT key FROM cache WHERE expires > ?", (time.time(),)).fetchall()
+        return iter(row[0] for row in rows)
+
+    def __len__(self):
+        return self._conn().execute("SELECT COUNT(*) FROM cache WHERE expires > ?", (time.time(),)).fetchone()[0]
+
+    def setdefault(self, key, default=None):
+        # One INSERT instead of MutableMapping's lookup-then-insert
+        self[key] = default
+        return default
+
+    def clear(self):
+        with self._pending_lock:
+            self._pending.clear()
+        self._conn().execute("DELETE FROM cache")
+
+    def prune(self):
+        """Drops expired rows, then the soonest-to-expire rows beyond maxsize."""
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,),
+        )
+
+
+def make_shared_backend():
+    """
+    Picks the shared second-level cache from CACHE_BACKEND.
+    'memory' (default) means none: each process only has its own segments.
+    'sqlite' adds a SQLiteCache that every worker on the host reads and fills.
+    """
+    backend = os.getenv('CACHE_BACKEND', 'memory').lower()
+    if backend == 'sqlite':
+        path = os.getenv('CACHE_PATH') or os.path.join(tempfile.gettempdir(), 'shiro-cache.sqlite3')
+        return SQLiteCache(path, maxsize=int(os.getenv('CACHE_MAXSIZE', 5000)))
+    return None
+
+
+def payload_size(value):
+    """Bytes a cached value costs, measured as its compact JSON encoding."""
+    try:
+        return len(json.dumps(value, separators=(',', ':')))
+    except (TypeError, ValueError):
+        return 1024
+
+
+def _evicting(base):
+    """cachetools subclass that reports capacity evictions (popitem) to a callback."""
+    class EvictingCache(base):
+        on_evict = None
+
+        def popitem(self):
+            key, value = super().popitem()
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+            return key, value
+    EvictingCache.__name__ = f"Evicting{base.__name__}"
+    return EvictingCache
+
+class _SoonestExpiry(Cache):
+    """
+    Evicts the entry that expires soonest (values are _Entry), so a short
+    retry/failure TTL goes before long-lived entries stored earlier. A heap
+    keeps eviction O(log n); superseded heap items are skipped and, once they
+    outnumber the live ones, compacted away.
+    """
+
+    def __init__(self, maxsize, getsizeof=None):
+        super().__init__(maxsize, getsizeof)
+        self._heap = []  # (expires_at, seq, key)
+        self._seq = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._seq += 1
+        heapq.heappush(self._heap, (value.expires_at, self._seq, key))
+        if len(self._heap) > 2 * len(self) + 64:
+            self._heap = [(entry.expires_at, seq, k) for seq, (k, entry) in enumerate(
+                (k, Cache.__getitem__(self, k)) for k in list(self.keys()))]
+            heapq.heapify(self._heap)
+            self._seq = len(self._heap)
+
+    def popitem(self):
+        while self._heap:
+            expires_at, _, key = heapq.heappop(self._heap)
+            try:
+                entry = Cache.__getitem__(self, key)
+            except KeyError:
+                continue
+            if entry.expires_at != expires_at:
+                continue  # replaced since this item was pushed
+            Cache.__delitem__(self, key)
+            return key, entry
+        raise KeyError(f'{type(self).__name__} is empty')
+
+_LRU, _LFU, _SOONEST = _evicting(LRUCache), _evicting(LFUCache), _evicting(_SoonestExpiry)
+
+
+class _Entry:
+    __slots__ = ('value', 'size', 'expires_at', 'stale_until')
+
+    def __init__(self, value, size, expires_at, stale_until):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.stale_until = stale_until
+
+
+class CacheSegment:
+    """
+    One named cache segment with its own TTL, byte budget and eviction policy.
+    Capacity is counted in payload bytes, not entries, so one huge info page
+    can't push out hundreds of small home-feed entries in another segment.
+    Policies: 'lru', 'lfu', or 'ttl' (evict whatever expires soonest; suits
+    short-lived stream links).
+    """
+
+    POLICIES = {'lru': _LRU, 'lfu': _LFU, 'ttl': _SOONEST}
+
+    def __init__(self, name, ttl, max_bytes, policy='lru', stale_ttl=0):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown cache policy '{policy}' for segment '{name}'")
+        self.name = name
+        self.ttl = ttl
+        # Expired entries are kept this much longer as a fallback for upstream outages
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._store = self.POLICIES[policy](maxsize=max_bytes, getsizeof=lambda entry: entry.size)
+        self._store.on_evict = self._on_evict
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = self.expirations = self.stale_hits = 0
+
+    def _on_evict(self, key, entry):
+        self.evictions += 1
+
+    def get(self, key):
+        """Returns (found, value)."""
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            now = time.time()
+            if entry.expires_at <= now:
+                if entry.stale_until <= now:
+                    del self._store[key]
+                    self.expirations += 1
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, entry.value
+
+    def get_stale(self, key):
+        """
+        Returns (found, value, stale_until) for an entry even if expired, as
+        long as it is within the stale window it got when first stored.
+        """
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is None or entry.stale_until <= time.time():
+                return False, None, None
+            self.stale_hits += 1
+            return True, entry.value, entry.stale_until
+
+    def set(self, key, value, size=None, ttl=None, stale_until=None):
+        """stale_until carries over the stale window of a value that is stored again after being served stale."""
+        expires_at = time.time() + (ttl or self.ttl)
+        if stale_until is None:
+            stale_until = expires_at + self.stale_ttl
+        entry = _Entry(value, payload_size(value) if size is None else size, min(expires_at, stale_until), stale_until)
+        with self._lock:
+            # Raises ValueError when the entry alone is bigger than the budget;
+            # @cached_payload treats that as "too large to cache".
+            self._store[key] = entry
+
+    def peek(self, key):
+        """(found, value) for an unexpired entry, without touching stats or LRU/LFU order."""
+        with self._lock:
+            try:
+                entry = Cache.__getitem__(self._store, key)
+            except KeyError:
+                return False, None
+        if entry.expires_at <= time.time():
+            return False, None
+        return True, entry.value
+
+    def contains(self, key):
+        """Whether key holds an unexpired entry, without touching stats or LRU/LFU order."""
+        return self.peek(key)[0]
+
+    def entries(self):
+        """(key, value, expires_at, size) for every unexpired entry, without touching stats or order."""
+        now = time.time()
+        with self._lock:
+            out = []
+            for key in list(self._store.keys()):
+                entry = Cache.__getitem__(self._store, key)
+                if entry.expires_at > now:
+                    out.append((key, entry.value, entry.expires_at, entry.size))
+        return out
+
+    def delete(self, key):
+        with self._lock:
+            del self._store[key]
+
+    def keys(self):
+        with self._lock:
+            return list(self._store.keys())
+
+    def __len__(self):
+        return len(self._store)
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'policy': self.policy,
+                'ttl': self.ttl,
+                'entries': len(self._store),
+                'bytes': self._store.currsize,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'stale_hits': self.stale_hits,
+            }
+
+
+class CacheManager(MutableMapping):
+    """
+    api_cache: a MutableMapping that routes each key to a named CacheSegment
+    by its endpoint, so it drops straight under @cached_payload.
+    An optional shared backend (see make_shared_backend) sits behind the
+    segments as a second level that all workers on the host share. The
+    mapping methods, which @cached_payload calls under api_cache_lock, only touch
+    memory; the shared level is read by get_shared (see @shared_first) and
+    written behind by the backend.
+    """
+
+    def __init__(self, segments, route, shared=None, failure_ttl=15):
+        self.segments = segments
+        self.route = route
+        self.shared = shared
+        self.failure_ttl = failure_ttl
+        # key -> (TTL, stale_until) for the next fill, set when a stale value is served
+        self._retry_ttls = {}
+        # key -> remaining TTL of a value just read from the shared level, so
+        # the fill that follows doesn't write it back or extend its life
+        self._promoted = {}
+
+    def segment_for(self, key):
+        return self.segments[self.route(key)]
+
+    def __getitem__(self, key):
+        found, value = self.segment_for(key).get(key)
+        if found:
+            return value
+        raise KeyError(key)
+
+    def get_shared(self, key):
+        """
+        (found, value) from the shared level. It does I/O, so it is for callers
+        outside api_cache_lock; a hit is promoted into this process by the
+        fill that follows.
+        """
+        if self.shared is None:
+            return False, None
+        try:
+            value, expires = self.shared.get_with_expiry(key)
+        except KeyError:
+            return False, None
+        self._promoted[key] = max(1, expires - time.time())
+        return True, value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value, size=None):
+        """
+        Stores value; `size` (payload_size(value)) can be worked out by the
+        caller before it takes api_cache_lock, see @cached_payload.
+        """
+        segment = self.segment_for(key)
+        ttl, stale_until = self._retry_ttls.pop(key, (None, None))
+        promoted_ttl = self._promoted.pop(key, None)
+        if promoted_ttl is not None:
+            # Another worker filled it; keep it only as long as the shared copy lives
+            segment.set(key, value, size=size, ttl=min(promoted_ttl, segment.ttl))
+            return
+        if value is None:
+            # A failed or over-budget fetch; retry it soon rather than after the full TTL
+            ttl = ttl or self.failure_ttl
+        segment.set(key, value, size=size, ttl=ttl, stale_until=stale_until)
+        if self.shared is not None:
+            self.shared.set(key, value, ttl=ttl or segment.ttl)
+
+    def serve_stale(self, key, retry_ttl=15):
+        """
+        Fallback when upstream failed: returns (found, value) from an expired
+        entry still in its stale window. The value @cached_payload stores back for
+        this key then only lives retry_ttl seconds, so upstream is retried soon,
+        and keeps the original stale window, so CACHE_STALE_TTL bounds how
+        long stale data is served however long the outage lasts.
+        """
+        found, value, stale_until = self.segment_for(key).get_stale(key)
+        if found:
+            self._retry_ttls[key] = (retry_ttl, stale_until)
+        return found, value
+
+    def contains(self, key):
+        """Non-counting membership check (the shared level is not consulted)."""
+        return self.segment_for(key).contains(key)
+
+    def setdefault(self, key, default=None, size=None):
+        # @cached_payload calls this after every miss, including from the
+        # threads that waited on the same coalesced fetch; only the first one
+        # stores (and writes to the shared level). peek() so the miss isn't
+        # counted twice.
+        found, value = self.segment_for(key).peek(key)
+        if found:
+            # Nothing is stored, so drop what get_shared left for this fill
+            self._promoted.pop(key, None)
+            return value
+        self.set(key, default, size=size)
+        return default
+
+    def __delitem__(self, key):
+        self.segment_for(key).delete(key)
+
+    def discard(self, key):
+        """Removes key from both levels if present."""
+        try:
+            self.segment_for(key).delete(key)
+        except KeyError:
+            pass
+        if self.shared is not None:
+            self.shared.discard(key)
+
+    def __iter__(self):
+        for segment in self.segments.values():
+            yield from segment.keys()
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments.values())
+
+    def clear(self):
+        for segment in self.segments.values():
+            segment.clear()
+
+    def stats(self):
+        return {name: segment.stats() for name, segment in self.segments.items()}
 
-load_dotenv()
+
+def route_cache_key(key):
+    """Maps an api_cache key (endpoint first) to its segment name."""
+    endpoint = key[0] if isinstance(key, tuple) and key else ''
+    if not isinstance(endpoint, str):
+        return 'search'
+    if endpoint.startswith('stream_'):
+        return 'streams'
+    if endpoint == 'info':
+        return 'info'
+    if endpoint.startswith('search-suggestions'):
+        return 'suggestions'
+    if endpoint in HOME_ENDPOINTS:
+        return 'home'
+    # Search results, category and genre pages
+    return 'search'
 
 # Cache configuration
-# We can use separate caches if needed, or a shared one. 
-# Given the high read nature, caching is good.
-api_cache = TTLCache(maxsize=200, ttl=300)
+# Per-endpoint segments: (TTL seconds, share of CACHE_BUDGET_MB, eviction policy).
+# Info pages are big and reused a lot, stream links are small but go stale fast.
+CACHE_BUDGET_MB = float(os.getenv('CACHE_BUDGET_MB', 64))
+# How long past expiry a value may still be served while upstream is down
+CACHE_STALE_TTL = int(os.getenv('CACHE_STALE_TTL', 3600))
+CACHE_SEGMENTS = {
+    'home':        (300,  0.10, 'lru'),
+    'info':        (1800, 0.45, 'lfu'),
+    'search':      (600,  0.20, 'lru'),
+    'suggestions': (900,  0.05, 'lfu'),
+    'streams':     (120,  0.20, 'ttl'),
+}
+
+api_cache = CacheManager(
+    {
+        name: CacheSegment(name, ttl, int(CACHE_BUDGET_MB * share * 1024 * 1024), policy, stale_ttl=CACHE_STALE_TTL)
+        for name, (ttl, share, policy) in CACHE_SEGMENTS.items()
+    },
+    route=route_cache_key,
+    shared=make_shared_backend(),
+)
+# Keeps the check-then-fill in @cached_payload atomic across Gunicorn threads
+api_cache_lock = threading.RLock()
 
 def make_cache_key(endpoint, params=None):
     if params is None:
@@ -17,33 +620,1516 @@ def make_cache_key(endpoint, params=None):
     # Convert params to a sorted tuple of items to be hashable
     return hashkey(endpoint, tuple(sorted(params.items())) if params else None)
 
+def fetch_cache_key(self, endpoint, params=None):
+    return make_cache_key(endpoint, params)
+
+def stream_cache_key(self, episode_id, category='sub', ep_num='1'):
+    return make_cache_key(f"stream_{episode_id}", {'category': category, 'ep': ep_num})
+
+
+class CacheSnapshot:
+    """
+    Periodic on-disk snapshot of api_cache and the home page's SWR tier, so a
+    restarted worker starts warm instead of sending a miss storm upstream after
+    every deploy.
+
+    The file is a sequence of length-prefixed zlib records, each holding
+    [key, expires_at, value] as JSON, or [key, expires_at, value, 'home'] for
+    the SWR tier. expires_at is wall-clock time, so entries that expired while
+    the process was down are dropped on load. The SWR tier is small and is
+    written first; each api_cache segment then gets a share of the rest of
+    max_bytes proportional to its budget, filled most recently cached first.
+    The file is written to a temp name and swapped in atomically.
+    """
+
+    MAGIC = b'SHIROCACHE1\n'
+    _LEN = struct.Struct('>I')
+
+    def __init__(self, cache, path, max_bytes, interval=300, home=None):
+        self.cache = cache
+        self.home = home
+        self.path = path
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.saved = self.loaded = self.dropped = 0
+
+    @staticmethod
+    def _decode_key(parts):
+        # JSON turned the key's nested tuples into lists
+        def to_tuple(part):
+            return tuple(to_tuple(p) for p in part) if isinstance(part, list) else part
+        return hashkey(*to_tuple(parts)) if isinstance(parts, list) else parts
+
+    @staticmethod
+    def _encode(*fields):
+        try:
+            return zlib.compress(json.dumps(list(fields), separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+        except (TypeError, ValueError):
+            return None
+
+    def _write(self, f, record):
+        f.write(self._LEN.pack(len(record)))
+        f.write(record)
+        return len(record) + self._LEN.size
+
+    def save(self):
+        """Writes the snapshot; returns the number of entries saved."""
+        budget_total = sum(seg.max_bytes for seg in self.cache.segments.values()) or 1
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        count = 0
+        with self._lock:
+            try:
+                with open(tmp, 'wb') as f:
+                    f.write(self.MAGIC)
+                    remaining = self.max_bytes
+                    for key, value, expires_at in (self.home.entries() if self.home is not None else ()):
+                        record = self._encode(key, expires_at, value, 'home')
+                        if record is None or len(record) > remaining:
+                            continue
+                        remaining -= self._write(f, record)
+                        count += 1
+                    for segment in self.cache.segments.values():
+                        budget = remaining * segment.max_bytes / budget_total
+                        used = 0
+                        # Most recently filled first: those are the ones worth keeping under the cap
+                        for key, value, expires_at, _ in sorted(segment.entries(), key=lambda e: e[2], reverse=True):
+                            record = self._encode(key, expires_at, value)
+                            if record is None:
+                                continue
+                            if used + len(record) > budget:
+                                break
+                            used += self._write(f, record)
+                            count += 1
+                os.replace(tmp, self.path)
+            except OSError as e:
+                log.warning("Couldn't write cache snapshot to %s: %s", self.path, e)
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+                return 0
+        self.saved = count
+        return count
+
+    def load(self):
+        """Fills the cache from the snapshot file, skipping expired entries; returns the number loaded."""
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return 0
+        now = time.time()
+        loaded = dropped = 0
+        with f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                log.warning("Ignoring cache snapshot %s: unknown format", self.path)
+                return 0
+            while True:
+                header = f.read(self._LEN.size)
+                if len(header) < self._LEN.size:
+                    break
+                record = f.read(self._LEN.unpack(header)[0])
+                try:
+                    key, expires_at, value, *tier = json.loads(zlib.decompress(record))
+                    key = self._decode_key(key)
+                except (zlib.error, ValueError, TypeError):
+                    # Truncated or corrupt tail; keep what loaded so far
+                    log.warning("Cache snapshot %s is damaged after %s entries", self.path, loaded)
+                    break
+                if expires_at <= now:
+                    dropped += 1
+                    continue
+                try:
+                    if tier == ['home']:
+                        if self.home is None:
+                            continue
+                        self.home.restore(key, value, expires_at)
+                    else:
+                        self.cache.segment_for(key).set(key, value, ttl=expires_at - now)
+                except ValueError:
+                    continue
+                loaded += 1
+        self.loaded, self.dropped = loaded, dropped
+        log.info("Loaded %s cache entries from %s (%s expired)", loaded, self.path, dropped)
+        return loaded
+
+    def ensure_started(self):
+        # Started lazily from the first upstream fetch, in the serving process
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='cache-snapshot', daemon=True)
+                self._thread.start()
+                atexit.register(self.save)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except Exception as e:
+                log.warning("Cache snapshot failed: %s", e)
+
+    def stats(self):
+        return {'saved': self.saved, 'loaded': self.loaded, 'dropped': self.dropped}
+
+
+class _Call:
+    """A single in-flight upstream call that other threads can wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Per-key in-flight deduplication.
+    The first thread to miss on a key runs the fetch, every other thread
+    that misses on the same key while it is running waits for that result.
+    """
+
+    def __init__(self, max_tracked_keys=1000):
+        self._lock = threading.Lock()
+        self._calls = {}
+        # Bounded so arbitrary search strings can't grow the stats forever
+        self._coalesced = LRUCache(maxsize=max_tracked_keys)
+        self.leaders = 0
+        self.waiters = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Runs func for key, or waits for the call already in flight."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.waiters += 1
+                self._coalesced[key] = self._coalesced.get(key, 0) + 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """Upstream calls made vs. calls saved by coalescing."""
+        with self._lock:
+            return {
+                'leaders': self.leaders,
+                'coalesced': self.waiters,
+                'in_flight': len(self._calls),
+                'top_keys': sorted(self._coalesced.items(), key=lambda kv: kv[1], reverse=True)[:20],
+            }
+
+
+def coalesce(flight, key):
+    """Decorator routing concurrent calls with the same key through one SingleFlight call."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return flight.do(key(*args, **kwargs), func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+inflight = SingleFlight()
+
+
+def cached_payload(cache, key, lock):
+    """
+    cachetools' @cached(cache, key, lock) for api_cache, except that the value
+    is sized (payload_size, a json.dumps of the whole payload) before the lock
+    is taken, so a large info page doesn't stall every other thread.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            k = key(*args, **kwargs)
+            with lock:
+                try:
+                    return cache[k]
+                except KeyError:
+                    pass
+            value = func(*args, **kwargs)
+            size = payload_size(value)
+            with lock:
+                try:
+                    return cache.setdefault(k, value, size=size)
+                except ValueError:
+                    return value  # too large to cache
+        return wrapper
+    return decorator
+
+
+def shared_first(cache, key):
+    """
+    Decorator answering from cache's shared level (CacheManager.get_shared)
+    before calling func. Goes under @coalesce, so only one thread per key does
+    the lookup, and it runs outside api_cache_lock.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            found, value = cache.get_shared(key(*args, **kwargs))
+            return value if found else func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StaleWhileRevalidateCache:
+    """
+    Two-tier TTL cache.
+    Entries younger than soft_ttl are fresh. Between soft_ttl and hard_ttl the
+    stale value is returned immediately and refreshed on a background worker.
+    Past hard_ttl the caller loads synchronously.
+    """
+
+    def __init__(self, soft_ttl, hard_ttl, maxsize=100, max_workers=2):
+        self.soft_ttl = soft_ttl
+        self.hard_ttl = max(hard_ttl, soft_ttl)
+        self._entries = LRUCache(maxsize=maxsize)  # key -> (value, fetched_at)
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='swr-refresh')
+        self.hits = self.stale_hits = self.misses = self.refreshes = 0
+
+    def age(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None else time.monotonic() - entry[1]
+
+    def entries(self):
+        """(key, value, wall-clock time it stops being servable) for every entry, for CacheSnapshot."""
+        offset = time.time() - time.monotonic()
+        with self._lock:
+            items = list(self._entries.items())
+        return [(key, value, fetched_at + offset + self.hard_ttl) for key, (value, fetched_at) in items]
+
+    def restore(self, key, value, expires_at):
+        """Re-adds a snapshot entry with the age it had, so a stale one is still refreshed on first use."""
+        fetched_at = time.monotonic() - (time.time() - (expires_at - self.hard_ttl))
+        with self._lock:
+            self._entries.setdefault(key, (value, fetched_at))
+
+    def get(self, key, loader):
+        with self._lock:
+            entry = self._entries.get(key)
+            age = None if entry is None else time.monotonic() - entry[1]
+            if age is not None and age < self.soft_ttl:
+                self.hits += 1
+                return entry[0]
+            stale = age is not None and age < self.hard_ttl
+            if stale:
+                self.stale_hits += 1
+            else:
+                self.misses += 1
+
+        if stale:
+            self.refresh_async(key, loader)
+            return entry[0]
+        return self.refresh(key, loader)
+
+    def refresh(self, key, loader):
+        """Loads key now. A failed load keeps whatever value is still cached."""
+        value = inflight.do(('swr', key), loader)
+        with self._lock:
+            if value is not None:
+                self._entries[key] = (value, time.monotonic())
+                self.refreshes += 1
+                return value
+            entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.hard_ttl:
+            return entry[0]
+        return None
+
+    def refresh_async(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def run():
+            try:
+                # Nobody is waiting on it, so it only spends upstream budget user traffic leaves
+                with lowered_priority():
+                    self.refresh(key, loader)
+            except Exception as e:
+                log.warning("Background refresh failed for %s: %s", key, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(run)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'refreshes': self.refreshes,
+            }
+
+
+class RefreshScheduler:
+    """
+    Keeps a set of hot keys warm by refreshing them shortly before they go stale,
+    so no user request ever has to wait on upstream for them.
+    """
+
+    def __init__(self, cache, interval=60):
+        self.cache = cache
+        self.interval = interval
+        self._hot = {}  # key -> loader
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, key, loader):
+        with self._lock:
+            self._hot[key] = loader
+
+    def ensure_started(self):
+        # Started lazily from the first request, not at import time,
+        # so it lives in the serving process rather than a pre-fork parent.
+        if self._thread is not None or self.interval <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='hot-key-refresher', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                hot = list(self._hot.items())
+            for key, loader in hot:
+                age = self.cache.age(key)
+                # Refresh anything that would go stale before the next tick
+                if age is None or age >= self.cache.soft_ttl - self.interval:
+                    self.cache.refresh_async(key, loader)
+            time.sleep(self.interval)
+
+
+# Home feed tier: served stale-while-revalidate and kept warm in the background
+HOME_SOFT_TTL = int(os.getenv('HOME_SOFT_TTL', 300))
+HOME_HARD_TTL = int(os.getenv('HOME_HARD_TTL', 1800))
+HOT_REFRESH_INTERVAL = int(os.getenv('HOT_REFRESH_INTERVAL', 60))
+HOME_ENDPOINTS = ['spotlight', 'recent-episodes', 'new-releases', 'top-upcoming', 'latest-completed', 'schedule/today']
+HOT_CATEGORIES = [c.strip() for c in os.getenv('HOT_CATEGORIES', 'recent-episodes,new-releases,movies,tv').split(',') if c.strip()]
+
+home_cache = StaleWhileRevalidateCache(soft_ttl=HOME_SOFT_TTL, hard_ttl=HOME_HARD_TTL)
+hot_refresher = RefreshScheduler(home_cache, interval=HOT_REFRESH_INTERVAL)
+
+# Warm restarts: load the last snapshot before serving, then keep it current
+CACHE_SNAPSHOT_INTERVAL = int(os.getenv('CACHE_SNAPSHOT_INTERVAL', 300))
+CACHE_SNAPSHOT_PATH = os.getenv('CACHE_SNAPSHOT_PATH') or os.path.join(tempfile.gettempdir(), 'shiro-cache.snapshot')
+CACHE_SNAPSHOT_MAX_MB = float(os.getenv('CACHE_SNAPSHOT_MAX_MB', 16))
+
+cache_snapshot = CacheSnapshot(
+    api_cache, CACHE_SNAPSHOT_PATH, int(CACHE_SNAPSHOT_MAX_MB * 1024 * 1024), interval=CACHE_SNAPSHOT_INTERVAL,
+    home=home_cache,
+)
+if CACHE_SNAPSHOT_INTERVAL > 0:
+    try:
+        cache_snapshot.load()
+    except Exception as e:  # a bad snapshot must never stop the app from booting
+        log.warning("Couldn't load cache snapshot: %s", e)
+
+
+class EncodedPayload:
+    """
+    A JSON response encoded once: raw, gzip and (if available) brotli bytes
+    plus a strong ETag. Degraded answers are not cacheable, by us or by clients.
+    """
+
+    __slots__ = ('body', 'gzip_body', 'br_body', 'etag', 'cacheable')
+
+    def __init__(self, body, gzip_body, br_body, etag, cacheable=True):
+        self.body = body
+        self.gzip_body = gzip_body
+        self.br_body = br_body
+        self.etag = etag
+        self.cacheable = cacheable
+
+def encode_payload(data):
+    body = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    br_body = brotli.compress(body, quality=5) if brotli is not None else None
+    return EncodedPayload(body, gzip.compress(body, 6), br_body, hashlib.sha1(body).hexdigest(),
+                          cacheable=not isinstance(data, Degraded))
+
+
+def negotiate_payload(payload, accept_encoding, if_none_match, max_age=60, s_maxage=None):
+    """
+    HTTP negotiation for an EncodedPayload, shared by app.py and asgi.py:
+    brotli or gzip when the client accepts them, 304 when If-None-Match
+    matches (weak comparison, so W/ tags added by proxies count too), and the
+    cache headers. Returns (status, body, headers); body is None on a 304.
+    """
+    from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+    accept = parse_accept_header(accept_encoding)
+    if payload.br_body is not None and 'br' in accept:
+        encoding, body = 'br', payload.br_body
+    elif 'gzip' in accept:
+        encoding, body = 'gzip', payload.gzip_body
+    else:
+        encoding, body = None, payload.body
+    # Strong ETags must differ per content-encoding
+    etag = f"{payload.etag}-{encoding}" if encoding else payload.etag
+
+    cache_control = f'public, max-age={max_age}'
+    if s_maxage is not None:
+        cache_control += f', s-maxage={s_maxage}'
+    headers = {
+        'ETag': quote_etag(etag),
+        # A degraded answer is only good for this request
+        'Cache-Control': cache_control if payload.cacheable else 'no-store',
+        'Vary': 'Accept-Encoding',
+    }
+    if parse_etags(if_none_match).contains_weak(etag):
+        return 304, None, headers
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return 200, body, headers
+
+
+class ResponseCache:
+    """
+    Response-level cache of EncodedPayloads, so a hit on api_cache isn't
+    re-serialized and re-compressed on every request. Each entry carries its own TTL.
+    """
+
+    def __init__(self, maxsize=500):
+        self._entries = LRUCache(maxsize=maxsize)  # key -> (payload, expires_at)
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, data, ttl):
+        """Encodes data and keeps it for ttl seconds; returns the payload either way."""
+        payload = encode_payload(data)
+        # Don't pin an upstream failure or a degraded answer for the whole TTL
+        if data and payload.cacheable:
+            with self._lock:
+                self._entries[key] = (payload, time.monotonic() + ttl)
+        return payload
+
+    def get_or_encode(self, key, producer, ttl):
+        payload = self.get(key)
+        if payload is not None:
+            return payload
+        return self.put(key, inflight.do(('response', key), producer), ttl)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+# Keep-alive connections kept per upstream host; match the Gunicorn thread count
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+
+def make_session(pool_size=HTTP_POOL_SIZE, retries=2, backoff=0.3):
+    """
+    requests.Session with a pooled keep-alive HTTPAdapter.
+    Only idempotent methods are retried (with exponential backoff),
+    so OAuth token POSTs are never replayed. 429 and 503 mean upstream is
+    shedding load, so they are returned as-is instead of retried into it.
+    Read timeouts aren't retried either: the breaker's adaptive timeout (and
+    the fan-out deadline above it) must bound the whole call, not one attempt.
+    """
+    # Imported here so requests/urllib3 stay off the cold-start import path
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=retries,
+        read=0,
+        backoff_factor=backoff,
+        status_forcelist=(500, 502, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def session_stats(session):
+    """
+    Per-host connection reuse for a session made by make_session.
+    'connections' is how many TCP/TLS handshakes were paid, 'requests' how many
+    requests went over them.
+    """
+    stats = {}
+    seen = set()
+    for adapter in session.adapters.values():
+        if id(adapter) in seen:
+            continue
+        seen.add(id(adapter))
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = f"{pool.scheme}://{pool.host}:{pool.port}"
+            stats[host] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'reused': max(pool.num_requests - pool.num_connections, 0),
+                'idle': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool is not None else 0,
+            }
+    return stats
+
+class SuggestionIndex:
+    """
+    In-process prefix index over every anime title seen in upstream responses,
+    so search-as-you-type can be answered locally.
+    Keys are (normalized word-suffix, anime_id) pairs in one sorted array, so
+    "ship" matches "Naruto Shippuden". New titles wait in a small pending buffer
+    and are merged into the array on compaction; past max_titles the least
+    recently seen titles are dropped.
+    """
+
+    # Fields the search dropdown in base.js renders; only scalar values are kept
+    # (an info payload's 'episodes' is the episode list, not a count)
+    FIELDS = ('id', 'title', 'image', 'type', 'sub', 'episodes', 'releaseDate')
+    SCALARS = (str, int, float, bool)
+    # Lists in upstream payloads that hold anime entries (not episodes)
+    LIST_KEYS = ('results', 'relations', 'recommendations', 'relatedAnime')
+
+    def __init__(self, max_titles=20000, compact_every=256, compact_interval=30):
+        self.max_titles = max_titles
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+        self._keys = []  # sorted (suffix, anime_id)
+        self._records = {}  # anime_id -> slim record
+        self._norms = {}  # anime_id -> normalized title
+        self._stale = False  # keys of evicted/retitled entries need filtering
+        self._seen = {}  # anime_id -> ingest tick, for the size cap
+        self._pending = []  # (suffix, anime_id) not merged yet
+        self._tick = 0
+        self._last_compact = time.monotonic()
+        self._lock = threading.Lock()
+        self.local_hits = self.upstream_fallbacks = 0
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(re.sub(r'[^0-9a-z]+', ' ', text.lower()).split())
+
+    @classmethod
+    def _suffixes(cls, title):
+        words = cls.normalize(title).split(' ')
+        return {' '.join(words[i:]) for i in range(len(words)) if words[i]}
+
+    def ingest(self, payload):
+        """Picks anime entries out of a search/category/genre/info payload."""
+        entries = []
+        if isinstance(payload, list):
+            entries = payload
+        elif isinstance(payload, dict):
+            entries = [payload]
+            for key in self.LIST_KEYS:
+                if isinstance(payload.get(key), list):
+                    entries.extend(payload[key])
+
+        with self._lock:
+            for entry in entries:
+                if not isinstance(entry, dict):
+                    continue
+                anime_id, title = entry.get('id'), entry.get('title')
+                if not anime_id or not isinstance(title, str):
+                    continue
+                self._tick += 1
+                self._seen[anime_id] = self._tick
+                record = {k: entry[k] for k in self.FIELDS if isinstance(entry.get(k), self.SCALARS)}
+                known = self._records.get(anime_id)
+                if known is not None and known['title'] == title:
+                    # Keep richer fields from earlier payloads (e.g. search vs info)
+                    known.update(record)
+                    continue
+                self._stale = self._stale or known is not None
+                self._records[anime_id] = record
+                self._norms[anime_id] = self.normalize(title)
+                self._pending.extend((suffix, anime_id) for suffix in self._suffixes(title))
+
+            if len(self._pending) >= self.compact_every:
+                self._compact()
+
+    def _compact(self):
+        """Merges pending keys into the sorted array and enforces the size cap. Caller holds the lock."""
+        self._keys = list(heapq.merge(self._keys, sorted(set(self._pending))))
+        self._pending = []
+        if len(self._records) > self.max_titles:
+            # Drop the least recently seen 10% beyond the cap in one pass
+            excess = len(self._records) - int(self.max_titles * 0.9)
+            for anime_id, _ in heapq.nsmallest(excess, self._seen.items(), key=lambda kv: kv[1]):
+                del self._records[anime_id]
+                del self._norms[anime_id]
+                del self._seen[anime_id]
+            self._stale = True
+        if self._stale:
+            # Drop keys of evicted or retitled entries
+            norms = self._norms
+            self._keys = [key for key in self._keys if key[0] in norms.get(key[1], '')]
+            self._stale = False
+        self._last_compact = time.monotonic()
+
+    def lookup(self, query, limit=10):
+        q = self.normalize(query)
+        if not q:
+            return []
+        with self._lock:
+            if self._pending and time.monotonic() - self._last_compact > self.compact_interval:
+                self._compact()
+            ids = []
+            keys = self._keys
+            i = bisect.bisect_left(keys, (q,))
+            while i < len(keys) and len(ids) < limit * 3:
+                suffix, anime_id = keys[i]
+                if not suffix.startswith(q):
+                    break
+                if anime_id not in ids:
+                    ids.append(anime_id)
+                i += 1
+            for suffix, anime_id in self._pending:
+                if suffix.startswith(q) and anime_id not in ids:
+                    ids.append(anime_id)
+            ids = [i for i in ids if i in self._records]
+            # Titles that start with the query first, then shorter titles
+            ids.sort(key=lambda i: (not self._norms[i].startswith(q), len(self._norms[i])))
+            return [self._records[i] for i in ids[:limit]]
+
+    def record_answer(self, local):
+        """Counts a suggestion answered from the index (local) or sent upstream."""
+        with self._lock:
+            if local:
+                self.local_hits += 1
+            else:
+                self.upstream_fallbacks += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'titles': len(self._records),
+                'keys': len(self._keys),
+                'pending': len(self._pending),
+                'local_hits': self.local_hits,
+                'upstream_fallbacks': self.upstream_fallbacks,
+            }
+
+class Degraded(dict):
+    """
+    A partial or empty answer given because upstream couldn't be asked (outage,
+    open circuit, or over the upstream budget) or had nothing for it.
+    Serialized like a plain dict, but neither ResponseCache nor HTTP caches
+    keep it.
+    """
+
+
+def suggestion_results(data):
+    """The result list of an upstream suggestions payload ({'results': [...]} or a bare list)."""
+    if isinstance(data, dict):
+        data = data.get('results')
+    return data if isinstance(data, list) else []
+
+# Answer suggestions locally when at least this many titles match
+SUGGEST_MIN_LOCAL = int(os.getenv('SUGGEST_MIN_LOCAL', 5))
+suggestion_index = SuggestionIndex(max_titles=int(os.getenv('SUGGEST_MAX_TITLES', 20000)))
+
+# Shared pool for issuing independent upstream calls together. Sized like the
+# HTTP pool (i.e. the server's thread count); when every worker is busy the
+# remaining calls run inline on the request thread instead of queueing behind
+# other requests' calls.
+FANOUT_WORKERS = int(os.getenv('FANOUT_WORKERS', HTTP_POOL_SIZE))
+FANOUT_TIMEOUT = float(os.getenv('FANOUT_TIMEOUT', 12))
+fanout_executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix='fanout')
+_fanout_slots = threading.BoundedSemaphore(FANOUT_WORKERS)
+
+
+class FanoutResults(dict):
+    """fetch_all's result; `missed` names the calls that raised or ran past the deadline."""
+
+    def __init__(self):
+        super().__init__()
+        self.missed = set()
+
+
+def fetch_all(calls, timeout=FANOUT_TIMEOUT):
+    """
+    Runs independent upstream calls concurrently under one shared deadline,
+    so a page waits for the slowest call instead of the sum of all of them.
+    `calls` maps a name to a zero-argument callable. The result maps the same
+    names to return values; a call that raised or missed the deadline maps to
+    None (and is listed in `results.missed`) so the caller can still render
+    what did come back, or tell "not found" apart from "didn't answer".
+    """
+    deadline = time.monotonic() + timeout
+    futures, inline = {}, []
+    for name, func in calls.items():
+        if _fanout_slots.acquire(blocking=False):
+            futures[name] = fanout_executor.submit(func)
+            # Fires on completion and on cancellation alike
+            futures[name].add_done_callback(lambda _: _fanout_slots.release())
+        else:
+            inline.append(name)
+
+    results = FanoutResults()
+    for name in inline:
+        try:
+            results[name] = calls[name]()
+        except Exception as e:
+            log.warning("Fan-out call '%s' failed: %s", name, e)
+            results[name] = None
+            results.missed.add(name)
+
+    wait(futures.values(), timeout=max(0, deadline - time.monotonic()))
+    for name, future in futures.items():
+        if not future.done():
+            log.warning("Fan-out call '%s' missed the %ss deadline", name, timeout)
+            future.cancel()
+            results[name] = None
+            results.missed.add(name)
+        elif future.exception() is not None:
+            log.warning("Fan-out call '%s' failed: %s", name, future.exception())
+            results[name] = None
+            results.missed.add(name)
+        else:
+            results[name] = future.result()
+    return results
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, bursting up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens=1, reserve=0):
+        """Takes tokens if at least `reserve` would be left afterwards."""
+        with self._lock:
+            self._refill()
+            if self._tokens - tokens >= reserve:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def spend(self, tokens=1):
+        """Takes tokens unconditionally; the bucket bottoms out at empty."""
+        with self._lock:
+            self._refill()
+            self._tokens = max(0, self._tokens - tokens)
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def wait_time(self, tokens=1):
+        """Seconds until `tokens` are available."""
+        with self._lock:
+            self._refill()
+            return max(0.0, (tokens - self._tokens) / self.rate) if self.rate > 0 else float('inf')
+
+
+class Prefetcher:
+    """
+    Warms api_cache for episodes a viewer is likely to open next.
+    Runs on a small bounded pool and is strictly best effort: when the queue
+    is full or the upstream rate budget is spent, prefetches are dropped
+    rather than competing with user requests.
+    """
+
+    def __init__(self, max_workers=2, max_pending=16, rate=2.0):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='prefetch')
+        self._bucket = TokenBucket(rate, capacity=max(rate * 2, 1))
+        self._lock = threading.Lock()
+        self._pending = set()
+        # Keys warmed by a prefetch and not yet requested by a user
+        self._warmed = LRUCache(maxsize=2000)
+        self.issued = self.hits = self.dropped = self.skipped = self.failed = 0
+
+    def submit(self, key, func, *args):
+        """Runs func(*args) in the background to fill `key`, unless cached, busy or over budget."""
+        if api_cache.contains(key):
+            self.skipped += 1
+            return False
+        with self._lock:
+            if key in self._pending:
+                return False
+            if (len(self._pending) >= self.max_pending or not upstream_budget.allows('low')
+                    or not self._bucket.try_acquire()):
+                self.dropped += 1
+                return False
+            self._pending.add(key)
+            self.issued += 1
+
+        def run():
+            try:
+                with lowered_priority():
+                    result = func(*args)
+                if result is not None:
+                    with self._lock:
+                        self._warmed[key] = True
+                else:
+                    # Don't leave the failure cached for the viewer's own request
+                    with api_cache_lock:
+                        api_cache.discard(key)
+                    self.failed += 1
+            except Exception as e:
+                self.failed += 1
+                log.info("Prefetch failed for %s: %s", key, e)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+        self._executor.submit(run)
+        return True
+
+    def note_request(self, key):
+        """Called on every user request for a prefetchable key, to measure hit rate."""
+        with self._lock:
+            if self._warmed.pop(key, None):
+                self.hits += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'issued': self.issued,
+                'hits': self.hits,
+                'hit_rate': round(self.hits / self.issued, 3) if self.issued else 0.0,
+                'dropped': self.dropped,
+                'skipped_cached': self.skipped,
+                'failed': self.failed,
+                'pending': len(self._pending),
+            }
+
+PREFETCH_PREVIOUS = os.getenv('PREFETCH_PREVIOUS', 'false').lower() == 'true'
+prefetcher = Prefetcher(
+    max_workers=int(os.getenv('PREFETCH_WORKERS', 2)),
+    rate=float(os.getenv('PREFETCH_RATE', 2)),
+)
+
+class CircuitBreaker:
+    """
+    Per-upstream circuit breaker with adaptive timeouts.
+
+    CLOSED: calls flow and their outcomes fill a sliding window. A call counts
+    as failed if it errored or took longer than slow_call. When the failure
+    rate over the window crosses failure_rate, the breaker OPENs and calls are
+    refused at once (callers fall back to stale cache) for `cooldown` seconds.
+    It then goes HALF_OPEN and lets `probes` trial calls through; if all
+    succeed it closes, if any fails it opens again.
+
+    timeout() adapts the request timeout to the observed p99 latency, clamped
+    between min_timeout and max_timeout.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, window=20, min_calls=10, failure_rate=0.5, slow_call=3.0,
+                 cooldown=15, probes=2, min_timeout=1.5, max_timeout=10.0, timeout_factor=3.0):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.cooldown = cooldown
+        self.probes = probes
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.timeout_factor = timeout_factor
+        self._outcomes = deque(maxlen=window)  # True = failed
+        self._latencies = deque(maxlen=200)
+        self._timeout = max_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probes_in_flight = self._probe_successes = 0
+        self.rejected = self.trips = 0
+
+    def allow(self):
+        """Whether a call may go upstream now."""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.cooldown:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probes_in_flight = self._probe_successes = 0
+            if self.state == self.HALF_OPEN:
+                if self._probes_in_flight >= self.probes:
+                    self.rejected += 1
+                    return False
+                self._probes_in_flight += 1
+            return True
+
+    def record(self, ok, latency):
+        failed = not ok or latency > self.slow_call
+        with self._lock:
+            if ok:
+                self._latencies.append(latency)
+                if len(self._latencies) % 10 == 0:
+                    self._recompute_timeout()
+
+            if self.state == self.HALF_OPEN:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if failed:
+                    self._trip()
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self.state = self.CLOSED
+                        self._outcomes.clear()
+                        log.warning("Circuit for %s closed", self.name)
+                return
+
+            self._outcomes.append(failed)
+            if len(self._outcomes) >= self.min_calls:
+                if sum(self._outcomes) / len(self._outcomes) >= self.failure_rate:
+                    self._trip()
+
+    def release(self):
+        """For a call allow() let through that ended without record() (a bug, a cancellation): frees its probe slot."""
+        with self._lock:
+            if self.state == self.HALF_OPEN and self._probes_in_flight > 0:
+                self._probes_in_flight -= 1
+
+    def _trip(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self.trips += 1
+        log.error("Circuit for %s opened, refusing calls for %ss", self.name, self.cooldown)
+
+    def _recompute_timeout(self):
+        ordered = sorted(self._latencies)
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        self._timeout = min(self.max_timeout, max(self.min_timeout, p99 * self.timeout_factor))
+
+    def timeout(self):
+        # Not enough samples yet: keep the old fixed timeout
+        return self._timeout if len(self._latencies) >= 20 else self.max_timeout
+
+    def stats(self):
+        with self._lock:
+            ordered = sorted(self._latencies)
+            return {
+                'state': self.state,
+                'failure_rate': round(sum(self._outcomes) / len(self._outcomes), 3) if self._outcomes else 0.0,
+                'timeout': round(self.timeout(), 3),
+                'p50': round(ordered[len(ordered) // 2], 3) if ordered else None,
+                'p99': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))], 3) if ordered else None,
+                'trips': self.trips,
+                'rejected': self.rejected,
+            }
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(base_url):
+    """One breaker per upstream, shared by every client (sync or async) that talks to it."""
+    with _breakers_lock:
+        breaker = _breakers.get(base_url)
+        if breaker is None:
+            breaker = _breakers[base_url] = CircuitBreaker(
+                base_url,
+                window=int(os.getenv('BREAKER_WINDOW', 20)),
+                failure_rate=float(os.getenv('BREAKER_FAILURE_RATE', 0.5)),
+                slow_call=float(os.getenv('BREAKER_SLOW_CALL', 3.0)),
+                cooldown=float(os.getenv('BREAKER_COOLDOWN', 15)),
+                max_timeout=float(os.getenv('UPSTREAM_TIMEOUT', 10)),
+            )
+        return breaker
+
+def breaker_stats():
+    with _breakers_lock:
+        return {name: breaker.stats() for name, breaker in _breakers.items()}
+
+def is_upstream_failure(error):
+    """4xx answers (e.g. unknown anime id) mean upstream is healthy, everything else counts against it."""
+    response = getattr(error, 'response', None)
+    return response is None or response.status_code >= 500 or response.status_code == 429
+
+# --- Upstream budget and per-client rate limits ---
+# Two layers keep user-controlled input from turning into unbounded upstream
+# traffic. Routes that take free-form queries or page numbers are rate limited
+# per client (RateLimiter); below them every BaseClient draws on one
+# process-wide UpstreamBudget. When that runs low, the cheapest traffic is shed
+# first: suggestions fall back to cache and the local index, then search and
+# browse pages, while watch/info requests always go through.
+
+PRIORITIES = ('critical', 'normal', 'low')
+_priority = threading.local()
+
+def request_priority(upstream, label):
+    """Budget priority for an upstream call; background work is demoted with lowered_priority()."""
+    override = getattr(_priority, 'value', None)
+    if override is not None:
+        return override
+    if upstream == 'stream' or label == 'info':
+        return 'critical'
+    if label == 'search-suggestions':
+        return 'low'
+    return 'normal'
+
+@contextmanager
+def lowered_priority(priority='low'):
+    """Upstream calls made by this thread inside the block spend the budget at `priority`."""
+    previous = getattr(_priority, 'value', None)
+    _priority.value = priority
+    try:
+        yield
+    finally:
+        _priority.value = previous
+
+
+class UpstreamBudget:
+    """
+    Process-wide cap on upstream requests per second, shared by every client.
+    Each priority may only spend while the bucket would keep its reserve (a
+    share of capacity), so as the budget drains 'low' is refused first, then
+    'normal'. 'critical' is never refused; it still draws the bucket down,
+    which is what pushes the others out under load. rate <= 0 disables it
+    (the default); size it from the upstream's real quota, and try it with
+    bench.loadtest --budget.
+    """
+
+    RESERVES = {'critical': 0.0, 'normal': 0.25, 'low': 0.5}
+
+    def __init__(self, rate, capacity=None):
+        self.bucket = TokenBucket(rate, capacity if capacity is not None else max(rate * 2, 1)) if rate > 0 else None
+        self._lock = threading.Lock()
+        self.spent = dict.fromkeys(PRIORITIES, 0)
+        self.refused = dict.fromkeys(PRIORITIES, 0)
+
+    def _reserve(self, priority):
+        return self.RESERVES[priority] * self.bucket.capacity
+
+    def try_spend(self, priority='normal'):
+        if self.bucket is None:
+            return True
+        if priority == 'critical':
+            self.bucket.spend()
+            allowed = True
+        else:
+            allowed = self.bucket.try_acquire(reserve=self._reserve(priority))
+        with self._lock:
+            (self.spent if allowed else self.refused)[priority] += 1
+        return allowed
+
+    def allows(self, priority='normal'):
+        """Whether a call at `priority` would currently be let through (nothing is spent)."""
+        if self.bucket is None or priority == 'critical':
+            return True
+        return self.bucket.available() - 1 >= self._reserve(priority)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.bucket is not None,
+                'available': round(self.bucket.available(), 2) if self.bucket is not None else None,
+                'capacity': self.bucket.capacity if self.bucket is not None else None,
+                'spent': dict(self.spent),
+                'refused': dict(self.refused),
+            }
+
+UPSTREAM_BUDGET_RATE = float(os.getenv('UPSTREAM_BUDGET_RATE', 0))
+upstream_budget = UpstreamBudget(
+    UPSTREAM_BUDGET_RATE,
+    capacity=float(os.getenv('UPSTREAM_BUDGET_BURST', UPSTREAM_BUDGET_RATE * 2)),
+)
+
+
+def parse_rate_limit(value, default):
+    """'5,20' -> (5.0 tokens per second, burst of 20.0); a bare '5' bursts to twice the rate."""
+    try:
+        parts = [float(part) for part in (value or '').split(',') if part.strip()]
+    except ValueError:
+        log.warning("Invalid rate limit %r, using %s", value, default)
+        return default
+    if not parts:
+        return default
+    return parts[0], parts[1] if len(parts) > 1 else max(parts[0] * 2, 1)
+
+# Per-client (rate per second, burst) for each limited route group
+RATE_LIMITS = {
+    'suggest': parse_rate_limit(os.getenv('RATE_LIMIT_SUGGEST'), (5.0, 20.0)),
+    'search': parse_rate_limit(os.getenv('RATE_LIMIT_SEARCH'), (1.0, 10.0)),
+    'genre': parse_rate_limit(os.getenv('RATE_LIMIT_GENRE'), (1.0, 10.0)),
+}
+# Client addresses come from X-Forwarded-For only behind a proxy that sets it (Vercel does)
+RATE_LIMIT_TRUST_FORWARDED = os.getenv('RATE_LIMIT_TRUST_FORWARDED', '1' if os.getenv('VERCEL') else '0') == '1'
+
+def client_key(remote_addr, forwarded_for=None, uid=None):
+    """Rate limit key: the logged-in user, else the client address."""
+    if uid:
+        return f'user:{uid}'
+    if RATE_LIMIT_TRUST_FORWARDED and forwarded_for:
+        return f"ip:{forwarded_for.split(',')[0].strip()}"
+    return f'ip:{remote_addr}'
+
+
+class RateLimiter:
+    """
+    Per-client token buckets in process memory, one per (rule, client).
+    Buckets idle for longer than idle_ttl are dropped (a full bucket is the
+    same as a new one), and at most max_clients are kept.
+    """
+
+    def __init__(self, limits, max_clients=10000, idle_ttl=600):
+        self.limits = limits
+        self._buckets = TTLCache(maxsize=max_clients, ttl=idle_ttl)
+        self._lock = threading.Lock()
+        self.allowed = dict.fromkeys(limits, 0)
+        self.limited = dict.fromkeys(limits, 0)
+
+    def hit(self, rule, key):
+        """Takes one token for `key` under `rule`; returns 0 if allowed, else seconds until it would be."""
+        rate, burst = self.limits[rule]
+        with self._lock:
+            bucket = self._buckets.get((rule, key))
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+            # Re-inserting refreshes the idle timer
+            self._buckets[(rule, key)] = bucket
+        if bucket.try_acquire():
+            self.allowed[rule] += 1
+            return 0.0
+        self.limited[rule] += 1
+        return bucket.wait_time()
+
+    def stats(self):
+        with self._lock:
+            clients = len(self._buckets)
+        return {'clients': clients, 'allowed': dict(self.allowed), 'limited': dict(self.limited)}
+
+
+class SQLiteRateLimiter(RateLimiter):
+    """
+    RateLimiter whose buckets live in a SQLite file, so every worker process
+    on the host enforces one shared limit per client. Each hit is a single
+    short write transaction.
+    """
+
+    def __init__(self, path, limits, idle_ttl=600):
+        super().__init__(limits, idle_ttl=idle_ttl)
+        self.path = path
+        self.idle_ttl = idle_ttl
+        self._local = threading.local()
+        self._hits = 0
+        self._conn().execute(
+            "CREATE TABLE IF NOT EXISTS rate_limit ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            import sqlite3
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def hit(self, rule, key):
+        rate, burst = self.limits[rule]
+        db_key = f'{rule}:{key}'
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated FROM rate_limit WHERE key = ?", (db_key,)).fetchone()
+            tokens = burst if row is None else min(burst, row[0] + max(0.0, now - row[1]) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            conn.execute("INSERT OR REPLACE INTO rate_limit (key, tokens, updated) VALUES (?, ?, ?)", (db_key, tokens, now))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self._lock:
+            (self.allowed if allowed else self.limited)[rule] += 1
+            self._hits += 1
+            prune = self._hits % 1000 == 0
+        if prune:
+            conn.execute("DELETE FROM rate_limit WHERE updated < ?", (now - self.idle_ttl,))
+        return 0.0 if allowed else (1 - tokens) / rate
+
+    def stats(self):
+        with self._lock:
+            allowed, limited = dict(self.allowed), dict(self.limited)
+        clients = self._conn().execute(
+            "SELECT COUNT(*) FROM rate_limit WHERE updated >= ?", (time.time() - self.idle_ttl,)
+        ).fetchone()[0]
+        return {'clients': clients, 'allowed': allowed, 'limited': limited}
+
+
+def make_rate_limiter():
+    """
+    Picks where per-client buckets live from RATE_LIMIT_BACKEND: 'memory'
+    (default, per process) or 'sqlite' (shared by every worker on the host).
+    """
+    backend = os.getenv('RATE_LIMIT_BACKEND', 'memory').lower()
+    if backend == 'sqlite':
+        path = os.getenv('RATE_LIMIT_PATH') or os.path.join(tempfile.gettempdir(), 'shiro-ratelimit.sqlite3')
+        return SQLiteRateLimiter(path, RATE_LIMITS)
+    return RateLimiter(RATE_LIMITS)
+
+rate_limiter = make_rate_limiter()
+
+# --- Payload projection ---
+# Upstream info and stream payloads carry far more than templates/*.html and
+# static/js read. They are trimmed to these fields before entering api_cache,
+# which shrinks both cache memory and every response built from them.
+
+CARD_FIELDS = ('id', 'title', 'image', 'type', 'episodes', 'relationType')
+SEASON_FIELDS = ('id', 'title', 'poster', 'isCurrent')
+INFO_FIELDS = (
+    'id', 'title', 'japaneseTitle', 'image', 'description', 'type', 'status', 'season',
+    'releaseDate', 'duration', 'rating', 'quality', 'malScore', 'hasDub', 'totalEpisodes',
+    'genres', 'studios', 'producers',
+)
+INFO_LISTS = {
+    'relations': CARD_FIELDS,
+    'recommendations': CARD_FIELDS,
+    'relatedAnime': CARD_FIELDS,
+    'seasons': SEASON_FIELDS,
+}
+STREAM_FIELDS = ('ok', 'count', 'anime_title', 'subtitle')
+SOURCE_FIELDS = ('url', 'quality', 'isM3U8', 'type')
+SERVER_FIELDS = ('name', 'url')
+EPISODE_PAGE_SIZE = 100
+
+def project(data, fields):
+    return {k: data[k] for k in fields if k in data}
+
+def project_list(items, fields):
+    return [project(item, fields) for item in items if isinstance(item, dict)] if isinstance(items, list) else items
+
+def pack_episodes(episodes):
+    """Episode dicts -> column arrays; a fraction of the size of one dict per episode."""
+    if isinstance(episodes, dict):  # already packed
+        return episodes
+    ids, numbers, titles = [], [], []
+    for ep in episodes or []:
+        if not isinstance(ep, dict):
+            continue
+        number, title = ep.get('number'), ep.get('title')
+        ids.append(ep.get('id'))
+        numbers.append(number)
+        # Templates fall back to "Episode N" themselves
+        titles.append(None if title == f'Episode {number}' else title)
+    return {'id': ids, 'number': numbers, 'title': titles}
+
+def project_info(data):
+    if not isinstance(data, dict):
+        return data
+    info = project(data, INFO_FIELDS)
+    for name, fields in INFO_LISTS.items():
+        if name in data:
+            info[name] = project_list(data[name], fields)
+    if 'episodes' in data:
+        info['episodes'] = pack_episodes(data['episodes'])
+    return info
+
+def project_stream(data):
+    if not isinstance(data, dict):
+        return data
+    stream = project(data, STREAM_FIELDS)
+    if isinstance(data.get('streams'), dict):
+        stream['streams'] = {'sources': project_list(data['streams'].get('sources', []), SOURCE_FIELDS)}
+    if 'servers' in data:
+        stream['servers'] = project_list(data['servers'], SERVER_FIELDS)
+    return stream
+
+# fetch() endpoint -> projection applied before caching
+PROJECTIONS = {'info': project_info}
+
+
+class Episode:
+    __slots__ = ('id', 'number', 'title')
+
+    def __init__(self, id, number, title):
+        self.id = id
+        self.number = number
+        self.title = title
+
+    def to_dict(self):
+        return {'id': self.id, 'number': self.number, 'title': self.title or f'Episode {self.number}'}
+
+
+class EpisodeList(Sequence):
+    """Read-only view over packed episode columns that templates can iterate and index like the old list of dicts."""
+
+    __slots__ = ('_columns',)
+
+    def __init__(self, columns):
+        self._columns = pack_episodes(columns)
+
+    def __len__(self):
+        return len(self._columns['id'])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        c = self._columns
+        return Episode(c['id'][i], c['number'][i], c['title'][i])
+
+    def page(self, page=1, per_page=EPISODE_PAGE_SIZE):
+        start = (page - 1) * per_page
+        return [ep.to_dict() for ep in self[start:start + per_page]]
+
+def with_episode_list(info):
+    """Cached info -> the shape templates expect, with episodes as an EpisodeList (no copying of the columns)."""
+    if not isinstance(info, dict) or 'episodes' not in info:
+        return info
+    return dict(info, episodes=EpisodeList(info['episodes']))
+
+def info_summary(info):
+    """Cached info for JSON responses: everything but the episode list, which is paged separately."""
+    if not isinstance(info, dict):
+        return info
+    summary = {k: v for k, v in info.items() if k != 'episodes'}
+    summary['episodeCount'] = len(pack_episodes(info.get('episodes'))['id'])
+    return summary
+
+def episode_page(info, page=1, per_page=EPISODE_PAGE_SIZE):
+    """One page of an info payload's episodes; Degraded (never cached) when there is no info."""
+    episodes = EpisodeList(info.get('episodes') if isinstance(info, dict) else None)
+    page_of = dict if info else Degraded
+    return page_of({
+        'currentPage': page,
+        'perPage': per_page,
+        'total': len(episodes),
+        'hasNextPage': page * per_page < len(episodes),
+        'results': episodes.page(page, per_page),
+    })
+
+
 class BaseClient:
+    # Metric label for this client's upstream
+    upstream = 'upstream'
+
     def __init__(self, base_url):
         self.base_url = base_url
+        self._session = None
+        self._session_lock = threading.Lock()
+        self.breaker = get_breaker(base_url)
+
+    @property
+    def session(self):
+        # Created by the first upstream call, not when the client is constructed at import
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = make_session()
+        return self._session
+
+    def connection_stats(self):
+        return session_stats(self._session) if self._session is not None else {}
 
     def _get(self, endpoint, params=None):
         """Internal get method with error handling."""
         if not self.base_url:
-            print(f"Error: Base URL not configured for {self.__class__.__name__}")
+            log.error("Base URL not configured for %s", self.__class__.__name__)
             return None
 
+        cache_snapshot.ensure_started()
+        label = endpoint_label(self.upstream, endpoint)
+        if not self.breaker.allow():
+            # Upstream is down: fail fast so callers can serve stale cache
+            UPSTREAM_REQUESTS.inc(upstream=self.upstream, endpoint=label, outcome='rejected')
+            return None
+        # Spend a token only for calls the breaker lets through
+        if not upstream_budget.try_spend(request_priority(self.upstream, label)):
+            # Over budget: callers fall back to stale cache like on an outage
+            self.breaker.release()
+            UPSTREAM_REQUESTS.inc(upstream=self.upstream, endpoint=label, outcome='over_budget')
+            return None
+
+        from requests.exceptions import RequestException
+        start = time.monotonic()
         try:
             url = f"{self.base_url}/{endpoint}"
-            print(f"[{self.__class__.__name__}] Fetching: {url} Params: {params}")
-            response = requests.get(url, params=params, timeout=10) # Added timeout
+            log_sampled(log, logging.INFO, "[%s] Fetching: %s Params: %s", self.__class__.__name__, url, params)
+            response = self.session.get(url, params=params, timeout=self.breaker.timeout())
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"[{self.__class__.__name__}] API Error: {e}")
+            data = response.json()
+        except RequestException as e:
+            elapsed = time.monotonic() - start
+            self.breaker.record(not is_upstream_failure(e), elapsed)
+            UPSTREAM_LATENCY.observe(elapsed, upstream=self.upstream, endpoint=label)
+            UPSTREAM_REQUESTS.inc(upstream=self.upstream, endpoint=label, outcome='error')
+            log.warning("[%s] API Error: %s", self.__class__.__name__, e)
             return None
+        except BaseException:
+            # Not an upstream outcome; a half-open probe must not hold its slot forever
+            self.breaker.release()
+            raise
+        elapsed = time.monotonic() - start
+        self.breaker.record(True, elapsed)
+        UPSTREAM_LATENCY.observe(elapsed, upstream=self.upstream, endpoint=label)
+        UPSTREAM_REQUESTS.inc(upstream=self.upstream, endpoint=label, outcome='ok')
+        return data
 
 class AnimeDataClient(BaseClient):
     """Client for general anime data (Spotlight, Search, Info)."""
+    upstream = 'anime'
     
     def __init__(self):
         super().__init__(os.getenv('BASE_URL'))
+        for endpoint in HOME_ENDPOINTS + HOT_CATEGORIES:
+            hot_refresher.register(make_cache_key(endpoint), functools.partial(self._get, endpoint))
 
-    @cached(api_cache, key=lambda self, endpoint, params=None: make_cache_key(endpoint, params))
+    def _get(self, endpoint, params=None):
+        data = super()._get(endpoint, params)
+        if data is not None and endpoint in PROJECTIONS:
+            data = PROJECTIONS[endpoint](data)
+        if data:
+            # Every title we see feeds the local suggestion index
+            suggestion_index.ingest(data)
+        return data
+
+    @cached_payload(api_cache, key=fetch_cache_key, lock=api_cache_lock)
+    @coalesce(inflight, key=fetch_cache_key)
+    @shared_first(api_cache, key=fetch_cache_key)
     def fetch(self, endpoint, params=None):
         """
         Fetches data from the anime API.
@@ -52,7 +2138,11 @@ class AnimeDataClient(BaseClient):
         """
         data = self._get(endpoint, params)
         if data is None:
-            print(f"[Services] Warning: No data received for endpoint '{endpoint}'")
+            found, stale = api_cache.serve_stale(fetch_cache_key(self, endpoint, params))
+            if found:
+                log.info("Upstream unavailable, serving stale '%s'", endpoint)
+                return stale
+            log.warning("No data received for endpoint '%s'", endpoint)
             # Default fallback based on expected return types could be complex,
             # but returning None allows the caller to handle 404s if needed,
             # OR we return empty structures. 
@@ -61,30 +2151,57 @@ class AnimeDataClient(BaseClient):
             return None
         return data
 
+    def fetch_uncached(self, endpoint, params=None):
+        """Straight to upstream, for bulk reads (the sitemap crawl) that would only evict what users need from api_cache."""
+        return self._get(endpoint, params)
+
+    def fetch_swr(self, endpoint, params=None):
+        """Fetch through the stale-while-revalidate home tier instead of api_cache."""
+        hot_refresher.ensure_started()
+        return home_cache.get(make_cache_key(endpoint, params), functools.partial(self._get, endpoint, params))
+
     def get_spotlight(self):
-        data = self.fetch('spotlight')
+        data = self.fetch_swr('spotlight')
         return data if data else []
 
     def get_recent_episodes(self):
-        data = self.fetch('recent-episodes')
+        data = self.fetch_swr('recent-episodes')
         return data if data else []
 
     def get_new_releases(self):
-        data = self.fetch('new-releases')
+        data = self.fetch_swr('new-releases')
         return data if data else []
 
     def get_top_upcoming(self):
-        data = self.fetch('top-upcoming')
+        data = self.fetch_swr('top-upcoming')
         return data if data else []
 
     def get_latest_completed(self):
-        data = self.fetch('latest-completed')
+        data = self.fetch_swr('latest-completed')
         return data if data else []
 
     def get_schedule(self):
-        data = self.fetch('schedule/today')
+        data = self.fetch_swr('schedule/today')
         return data if data else []
 
+    def get_home_feed(self):
+        """
+        Every home page section in one parallel pass, keyed like the /api/home/*
+        routes. Degraded (so not cached) if any section failed or came back empty.
+        """
+        sections = {
+            'spotlight': self.get_spotlight,
+            'recent-episodes': self.get_recent_episodes,
+            'new-releases': self.get_new_releases,
+            'upcoming': self.get_top_upcoming,
+            'completed': self.get_latest_completed,
+            'schedule': self.get_schedule,
+        }
+        results = fetch_all(sections)
+        # In section order: fetch_all lists calls it ran inline first
+        feed = {name: results[name] or [] for name in sections}
+        return feed if all(feed.values()) else Degraded(feed)
+
     def search(self, query, page=1):
         if not query:
             return {'results': []} # mimics structure
@@ -97,17 +2214,48 @@ class AnimeDataClient(BaseClient):
         return data if data else {'results': []}
 
     def get_search_suggestions(self, query):
+        """{'results': [...]} for the query, whichever source answered it."""
         if not query:
-            return []
+            return {'results': []}
+        results = suggestion_index.lookup(query)
+        if self._answer_locally(results):
+            return {'results': results}
         data = self.fetch('search-suggestions', {'query': query})
-        return data if data else []
+        if data is None:
+            return Degraded(results=results)
+        return {'results': suggestion_results(data) or results}
+
+    def suggest(self, query):
+        """Search-as-you-type results as {'results': [...]}, like the upstream search-suggestions/<query> payload."""
+        results = suggestion_index.lookup(query)
+        if self._answer_locally(results):
+            return {'results': results}
+        # Over budget this is cached-only: a miss comes back as None and the sparse local results stand in
+        data = self.fetch(f'search-suggestions/{query}')
+        if data is None:
+            return Degraded(results=results)
+        return {'results': suggestion_results(data) or results}
+
+    @staticmethod
+    def _answer_locally(results):
+        """Whether local index results are enough, or upstream should answer."""
+        local = len(results) >= SUGGEST_MIN_LOCAL
+        suggestion_index.record_answer(local)
+        return local
 
     def get_info(self, anime_id):
-        data = self.fetch('info', {'id': anime_id})
-        return data
+        """Info with episodes as an EpisodeList, for templates; see info_summary/episode_page for JSON."""
+        return with_episode_list(self.get_info_data(anime_id))
+
+    def get_info_data(self, anime_id):
+        """Info as cached: projected, with episodes packed into columns."""
+        return self.fetch('info', {'id': anime_id})
 
     def get_by_category(self, category, page=1):
-        data = self.fetch(category, params={'page': page} if page > 1 else None)
+        if page > 1:
+            data = self.fetch(category, params={'page': page})
+        else:
+            data = self.fetch_swr(category)
         return data if data else []
 
     def get_by_genre(self, genre, page=1):
@@ -118,15 +2266,99 @@ class AnimeDataClient(BaseClient):
 
 class StreamClient(BaseClient):
     """Client for streaming links and DB interactions."""
+    upstream = 'stream'
 
     def __init__(self):
         super().__init__(os.getenv('STREAM_URL'))
 
-    @cached(api_cache, key=lambda self, episode_id, category='sub', ep_num='1': make_cache_key(f"stream_{episode_id}", {'category': category, 'ep': ep_num}))
     def get_stream_data(self, episode_id, category='sub', ep_num='1'):
         """
         Fetches streaming data.
         """
+        prefetcher.note_request(stream_cache_key(self, episode_id, category, ep_num))
+        return self._fetch_stream(episode_id, category, ep_num)
+
+    @cached_payload(api_cache, key=stream_cache_key, lock=api_cache_lock)
+    @coalesce(inflight, key=stream_cache_key)
+    @shared_first(api_cache, key=stream_cache_key)
+    def _fetch_stream(self, episode_id, category='sub', ep_num='1'):
         params = {'ep': ep_num, 'category': category}
-        data = self._get(episode_id, params)
+        data = project_stream(self._get(episode_id, params))
+        if data is None:
+            found, stale = api_cache.serve_stale(stream_cache_key(self, episode_id, category, ep_num))
+            if found:
+                return stale
         return data
+
+    def prefetch_adjacent(self, episode_id, category='sub', ep_num='1', total=None):
+        """Warms stream data for the next (and optionally previous) episode in the background."""
+        try:
+            current = int(ep_num)
+        except (TypeError, ValueError):
+            return
+        candidates = [current + 1] + ([current - 1] if PREFETCH_PREVIOUS else [])
+        for ep in candidates:
+            if ep < 1 or (total and ep > total):
+                continue
+            ep = str(ep)
+            prefetcher.submit(
+                stream_cache_key(self, episode_id, category, ep),
+                self._fetch_stream, episode_id, category, ep,
+            )
+
+
+def collect_metrics():
+    """Exports the counters the cache and upstream components already keep; run on scrape."""
+    for name, seg in api_cache.stats().items():
+        labels = {'segment': name}
+        yield 'shiro_cache_hits_total', 'counter', 'api_cache hits per segment', labels, seg['hits']
+        yield 'shiro_cache_misses_total', 'counter', 'api_cache misses per segment', labels, seg['misses']
+        yield 'shiro_cache_evictions_total', 'counter', 'api_cache capacity evictions per segment', labels, seg['evictions']
+        yield 'shiro_cache_stale_hits_total', 'counter', 'Stale values served during upstream failures', labels, seg['stale_hits']
+        yield 'shiro_cache_bytes', 'gauge', 'Payload bytes held per segment', labels, seg['bytes']
+        yield 'shiro_cache_budget_bytes', 'gauge', 'Byte budget per segment', labels, seg['max_bytes']
+        yield 'shiro_cache_entries', 'gauge', 'Entries per segment', labels, seg['entries']
+
+    snap = cache_snapshot.stats()
+    yield 'shiro_cache_snapshot_entries', 'gauge', 'Entries written in the last api_cache snapshot', {}, snap['saved']
+    yield 'shiro_cache_snapshot_loaded', 'gauge', 'Entries restored from the snapshot at startup', {}, snap['loaded']
+
+    home = home_cache.stats()
+    for result in ('hits', 'stale_hits', 'misses'):
+        yield 'shiro_home_cache_requests_total', 'counter', 'Home feed tier lookups', {'result': result}, home[result]
+
+    flight = inflight.stats()
+    yield 'shiro_singleflight_leaders_total', 'counter', 'Upstream fetches that ran', {}, flight['leaders']
+    yield 'shiro_singleflight_coalesced_total', 'counter', 'Cache misses that waited on an in-flight fetch', {}, flight['coalesced']
+
+    index = suggestion_index.stats()
+    yield 'shiro_suggestion_index_titles', 'gauge', 'Titles in the local suggestion index', {}, index['titles']
+    yield 'shiro_suggestion_local_hits_total', 'counter', 'Suggestions answered locally', {}, index['local_hits']
+    yield 'shiro_suggestion_upstream_fallbacks_total', 'counter', 'Suggestions sent upstream', {}, index['upstream_fallbacks']
+
+    pre = prefetcher.stats()
+    for result in ('issued', 'hits', 'dropped', 'failed'):
+        yield 'shiro_prefetch_total', 'counter', 'Episode prefetches by result', {'result': result}, pre[result]
+
+    budget = upstream_budget.stats()
+    if budget['enabled']:
+        yield 'shiro_upstream_budget_available', 'gauge', 'Tokens left in the process-wide upstream budget', {}, budget['available']
+        for priority in PRIORITIES:
+            labels = {'priority': priority}
+            yield 'shiro_upstream_budget_spent_total', 'counter', 'Upstream calls let through by the budget', labels, budget['spent'][priority]
+            yield 'shiro_upstream_budget_refused_total', 'counter', 'Upstream calls refused by the budget', labels, budget['refused'][priority]
+
+    limits = rate_limiter.stats()
+    yield 'shiro_rate_limit_clients', 'gauge', 'Clients with an active rate limit bucket', {}, limits['clients']
+    for rule in RATE_LIMITS:
+        labels = {'rule': rule}
+        yield 'shiro_rate_limit_requests_total', 'counter', 'Rate limited route requests', dict(labels, result='allowed'), limits['allowed'][rule]
+        yield 'shiro_rate_limit_requests_total', 'counter', 'Rate limited route requests', dict(labels, result='limited'), limits['limited'][rule]
+
+    for name, breaker in breaker_stats().items():
+        labels = {'upstream': name}
+        yield 'shiro_circuit_open', 'gauge', '1 when the upstream circuit is not closed', labels, breaker['state'] != 'closed'
+        yield 'shiro_circuit_trips_total', 'counter', 'Times the circuit opened', labels, breaker['trips']
+        yield 'shiro_upstream_timeout_seconds', 'gauge', 'Current adaptive upstream timeout', labels, breaker['timeout']
+
+REGISTRY.add_collector(collect_metrics)
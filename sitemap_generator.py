@@ -1,70 +1,272 @@
-def generate_sitemap_xml(base_url):
-    # Static pages
-    pages = [
-        '/login',
-        '/terms',
-        '/privacy',
-        '/search',
-        '/profile'
-    ]
-    
-    # Dynamic categories
-    categories = [
-        '/browse/movies',
-        '/browse/tv',
-        '/browse/ova',
-        '/browse/ona',
-        '/browse/specials',
-        '/browse/recent-episodes',
-        '/browse/new-releases',
-        '/browse/latest-completed'
-    ]
-
-    # Genres
-    genres = [
-        'action', 'adventure', 'cars', 'comedy', 'dementia', 'demons', 'drama', 
-        'ecchi', 'fantasy', 'game', 'harem', 'historical', 'horror', 'josei', 
-        'kids', 'magic', 'martial-arts', 'mecha', 'military', 'music', 'mystery', 
-        'parody', 'police', 'psychological', 'romance', 'samurai', 'school', 
-        'sci-fi', 'seinen', 'shoujo', 'shoujo-ai', 'shounen', 'shounen-ai', 
-        'slice-of-life', 'space', 'sports', 'super-power', 'supernatural', 
-        'thriller', 'vampire', 'yaoi', 'yuri'
-    ]
-    
-    xml_content = ['<?xml version="1.0" encoding="UTF-8"?>']
-    xml_content.append('<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">')
-    
-    # Add Home page (Highest priority)
-    xml_content.append('<url>')
-    xml_content.append(f'<loc>{base_url}</loc>')
-    xml_content.append('<changefreq>daily</changefreq>')
-    xml_content.append('<priority>1.0</priority>')
-    xml_content.append('</url>')
-    
-    # Add static pages
-    for page in pages:
-        xml_content.append('<url>')
-        xml_content.append(f'<loc>{base_url}{page}</loc>')
-        xml_content.append('<changefreq>daily</changefreq>')
-        xml_content.append('<priority>0.8</priority>')
-        xml_content.append('</url>')
-
-    # Add categories
-    for cat in categories:
-        xml_content.append('<url>')
-        xml_content.append(f'<loc>{base_url}{cat}</loc>')
-        xml_content.append('<changefreq>daily</changefreq>')
-        xml_content.append('<priority>0.6</priority>')
-        xml_content.append('</url>')
-
-    # Add genres
-    for genre in genres:
-        xml_content.append('<url>')
-        xml_content.append(f'<loc>{base_url}/genre/{genre}</loc>')
-        xml_content.append('<changefreq>weekly</changefreq>')
-        xml_content.append('<priority>0.7</priority>')
-        xml_content.append('</url>')
-        
-    xml_content.append('</urlset>')
-    
-    return '\n'.join(xml_content)
+import os
+import json
+import math
+import time
+import zlib
+import logging
+import threading
+from datetime import datetime, timezone
+from contextlib import contextmanager
+from xml.sax.saxutils import escape
+from services import lowered_priority
+
+try:
+    import fcntl
+except ImportError:  # not on Windows; every process crawls for itself there
+    fcntl = None
+
+# The sitemap is built from a snapshot of the catalogue that a background thread
+# refreshes by paging through category and genre listings. Requests only ever
+# render the current snapshot, so a crawler hitting /sitemap.xml never causes
+# upstream traffic, and the snapshot's build time doubles as Last-Modified.
+# Workers sharing SITEMAP_PATH take turns: whoever holds the lock file crawls,
+# the rest pick up the snapshot it saves.
+
+log = logging.getLogger('shiro.sitemap')
+
+SHARD_SIZE = 50000  # sitemaps.org limit of URLs per file
+SITEMAP_REFRESH = int(os.getenv('SITEMAP_REFRESH', 6 * 3600))
+SITEMAP_MAX_PAGES = int(os.getenv('SITEMAP_MAX_PAGES', 100))  # per category/genre listing
+SITEMAP_CRAWL_DELAY = float(os.getenv('SITEMAP_CRAWL_DELAY', 0.2))
+SITEMAP_PATH = os.getenv('SITEMAP_PATH', '/tmp/shiro-sitemap.json')
+SITEMAP_LOCK_POLL = 60  # seconds between checks for another worker's snapshot while it crawls
+
+# Static pages
+PAGES = [
+    '/login',
+    '/terms',
+    '/privacy',
+    '/search',
+    '/profile'
+]
+
+# Dynamic categories
+CATEGORIES = [
+    'movies',
+    'tv',
+    'ova',
+    'ona',
+    'specials',
+    'recent-episodes',
+    'new-releases',
+    'latest-completed'
+]
+
+# Genres
+GENRES = [
+    'action', 'adventure', 'cars', 'comedy', 'dementia', 'demons', 'drama',
+    'ecchi', 'fantasy', 'game', 'harem', 'historical', 'horror', 'josei',
+    'kids', 'magic', 'martial-arts', 'mecha', 'military', 'music', 'mystery',
+    'parody', 'police', 'psychological', 'romance', 'samurai', 'school',
+    'sci-fi', 'seinen', 'shoujo', 'shoujo-ai', 'shounen', 'shounen-ai',
+    'slice-of-life', 'space', 'sports', 'super-power', 'supernatural',
+    'thriller', 'vampire', 'yaoi', 'yuri'
+]
+
+
+def static_urls():
+    """(path, changefreq, priority) for every page that doesn't come from the catalogue."""
+    # Home page (Highest priority)
+    yield ('', 'daily', '1.0')
+    for page in PAGES:
+        yield (page, 'daily', '0.8')
+    for cat in CATEGORIES:
+        yield (f'/browse/{cat}', 'daily', '0.6')
+    for genre in GENRES:
+        yield (f'/genre/{genre}', 'weekly', '0.7')
+
+
+class SitemapSnapshot:
+    """Immutable URL list for one build; requests render whichever snapshot was current when they started."""
+
+    __slots__ = ('urls', 'last_modified')
+
+    def __init__(self, anime_ids, built_at):
+        self.urls = list(static_urls())
+        self.urls.extend((f'/anime/{anime_id}', 'weekly', '0.5') for anime_id in anime_ids)
+        # HTTP dates have one-second resolution
+        self.last_modified = datetime.fromtimestamp(int(built_at), timezone.utc)
+
+    @property
+    def shard_count(self):
+        return max(1, math.ceil(len(self.urls) / SHARD_SIZE))
+
+    def render_index(self, base_url):
+        lastmod = self.last_modified.strftime('%Y-%m-%dT%H:%M:%SZ')
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        for n in range(self.shard_count):
+            yield f'<sitemap><loc>{escape(base_url)}/sitemaps/{n}.xml</loc><lastmod>{lastmod}</lastmod></sitemap>\n'
+        yield '</sitemapindex>\n'
+
+    def render_shard(self, base_url, n, chunk=1000):
+        """Yields the XML of shard n in pieces, or returns None if there is no such shard."""
+        if not 0 <= n < self.shard_count:
+            return None
+        return self._render_shard(escape(base_url), self.urls[n * SHARD_SIZE:(n + 1) * SHARD_SIZE], chunk)
+
+    @staticmethod
+    def _render_shard(base_url, urls, chunk):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+        for i in range(0, len(urls), chunk):
+            yield ''.join(
+                f'<url><loc>{base_url}{escape(path)}</loc><changefreq>{freq}</changefreq><priority>{priority}</priority></url>\n'
+                for path, freq, priority in urls[i:i + chunk]
+            )
+        yield '</urlset>\n'
+
+
+def encode_stream(chunks, compress=False):
+    """UTF-8 encodes rendered chunks, gzipping them on the fly when asked."""
+    if not compress:
+        for piece in chunks:
+            yield piece.encode('utf-8')
+        return
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for piece in chunks:
+        data = gz.compress(piece.encode('utf-8'))
+        if data:
+            yield data
+    yield gz.flush()
+
+
+class Sitemap:
+    """
+    Owns the current SitemapSnapshot and the background crawl that replaces it.
+    The anime IDs from the last crawl are saved to disk, so a restarted worker
+    serves the full catalogue straight away instead of only the static pages,
+    and other workers on the host adopt it instead of crawling again.
+    """
+
+    def __init__(self, client, refresh=SITEMAP_REFRESH, path=SITEMAP_PATH,
+                 max_pages=SITEMAP_MAX_PAGES, crawl_delay=SITEMAP_CRAWL_DELAY):
+        self.client = client
+        self.refresh = refresh
+        self.path = path
+        self.max_pages = max_pages
+        self.crawl_delay = crawl_delay
+        self._ids, self._built_at = self._load()
+        self.snapshot = SitemapSnapshot(self._ids, self._built_at)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def ensure_started(self):
+        # Started from the first sitemap request, in the serving process
+        if self._thread is not None or self.refresh <= 0:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sitemap-crawler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                wait = self.update()
+            except Exception as e:
+                log.warning("Sitemap crawl failed: %s", e)
+                wait = self.refresh
+            time.sleep(wait)
+
+    def update(self):
+        """
+        Brings the snapshot up to date: adopts a fresh one saved by another
+        worker, or crawls if this worker gets the crawl lock. Returns the
+        number of seconds until it should be called again.
+        """
+        if not self._adopt_saved():
+            with self._crawl_lock() as acquired:
+                if not acquired:
+                    return SITEMAP_LOCK_POLL
+                # Another worker may have finished a crawl just before we got the lock
+                if not self._adopt_saved():
+                    # Background work: only spends upstream budget that user traffic leaves
+                    with lowered_priority():
+                        self.crawl()
+        return max(SITEMAP_LOCK_POLL, self.refresh - (time.time() - self._built_at))
+
+    def _adopt_saved(self):
+        """Takes over a newer saved snapshot; True if the snapshot is fresh enough to skip a crawl."""
+        ids, built_at = self._load()
+        if ids and built_at > self._built_at:
+            self._ids, self._built_at = ids, built_at
+            self.snapshot = SitemapSnapshot(ids, built_at)
+        return bool(self._ids) and time.time() - self._built_at < self.refresh
+
+    @contextmanager
+    def _crawl_lock(self):
+        if not self.path or fcntl is None:
+            yield True
+            return
+        try:
+            f = open(f'{self.path}.lock', 'a')
+        except OSError as e:
+            log.warning("Couldn't open the sitemap lock file, crawling anyway: %s", e)
+            yield True
+            return
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def crawl(self):
+        start = time.monotonic()
+        ids = {}  # ordered set
+        # Uncached: a full crawl through api_cache would evict the entries users are hitting
+        for cat in CATEGORIES:
+            self._crawl_listing(lambda page, cat=cat: self.client.fetch_uncached(cat, {'page': page}), ids)
+        for genre in GENRES:
+            self._crawl_listing(lambda page, genre=genre: self.client.fetch_uncached(f'genre/{genre}', {'page': page}), ids)
+
+        # A crawl cut short by an upstream outage shouldn't shrink the sitemap
+        if len(ids) < len(self._ids) / 2:
+            log.warning("Sitemap crawl found %s titles (previously %s); keeping the previous ones too", len(ids), len(self._ids))
+            ids.update(dict.fromkeys(self._ids))
+
+        self._ids = list(ids)
+        self._built_at = time.time()
+        self.snapshot = SitemapSnapshot(self._ids, self._built_at)
+        self._save(self._built_at)
+        log.info("Sitemap rebuilt: %s titles, %s shards in %.1fs",
+                 len(self._ids), self.snapshot.shard_count, time.monotonic() - start)
+
+    def _crawl_listing(self, load, ids):
+        for page in range(1, self.max_pages + 1):
+            data = load(page)
+            results = data.get('results') if isinstance(data, dict) else None
+            if not results:
+                break
+            before = len(ids)
+            for item in results:
+                if isinstance(item, dict) and item.get('id'):
+                    ids.setdefault(item['id'], None)
+            # Stop on the last page, or if upstream keeps returning the same titles
+            if not data.get('hasNextPage') or len(ids) == before:
+                break
+            time.sleep(self.crawl_delay)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            return list(saved['ids']), float(saved['built_at'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return [], time.time()
+
+    def _save(self, built_at):
+        if not self.path:
+            return
+        tmp = f'{self.path}.{os.getpid()}.tmp'  # never shared with a worker saving at the same time
+        try:
+            with open(tmp, 'w') as f:
+                json.dump({'built_at': built_at, 'ids': self._ids}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("Couldn't save sitemap snapshot to %s: %s", self.path, e)
@@ -1,80 +1,83 @@
 document.addEventListener('DOMContentLoaded', () => {
-    // Initial fetch for all sections
-    fetchHero();
-    fetchRecentUpdates();
-    fetchTripleList('new-releases', 'new-releases');
-    fetchTripleList('upcoming', 'upcoming');
-    fetchTripleList('completed', 'completed');
-    fetchTrending();
-    fetchSchedule();
+    // One request hydrates every section
+    fetchHomeFeed();
 });
 
 /* --- Data Fetching & Rendering --- */
 
-async function fetchHero() {
+async function fetchHomeFeed() {
+    let feed;
+    try {
+        const response = await fetch('/api/home/feed');
+        feed = await response.json();
+    } catch (error) {
+        console.error('Error fetching home feed:', error);
+        return;
+    }
+
+    showHero(feed['spotlight']);
+    showRecentUpdates(feed['recent-episodes']);
+    showTripleList(feed['new-releases'], 'new-releases');
+    showTripleList(feed['upcoming'], 'upcoming');
+    showTripleList(feed['completed'], 'completed');
+    showTrending(feed['new-releases']);
+    showSchedule(feed['schedule']);
+}
+
+function showHero(data) {
     try {
-        const response = await fetch('/api/home/spotlight');
-        const data = await response.json();
         const results = data.results || data; // Handle pagination or list
         if (results && results.length > 0) {
             renderHero(results);
             initSlider(); // Re-init slider after DOM update
         }
     } catch (error) {
-        console.error('Error fetching spotlight:', error);
+        console.error('Error rendering spotlight:', error);
     }
 }
 
-async function fetchRecentUpdates() {
+function showRecentUpdates(data) {
     try {
-        const response = await fetch('/api/home/recent-episodes');
-        const data = await response.json();
         const results = data.results || data;
         if (results) {
             renderGrid(results.slice(0, 12), 'recent-updates');
         }
     } catch (error) {
-        console.error('Error fetching recent updates:', error);
+        console.error('Error rendering recent updates:', error);
     }
 }
 
-async function fetchTripleList(endpointKey, containerId) {
+function showTripleList(data, containerId) {
     try {
-        const response = await fetch(`/api/home/${endpointKey}`);
-        const data = await response.json();
         const results = data.results || data;
         if (results) {
             renderVerticalList(results.slice(0, 6), containerId);
         }
     } catch (error) {
-        console.error(`Error fetching ${endpointKey}:`, error);
+        console.error(`Error rendering ${containerId}:`, error);
     }
 }
 
-async function fetchTrending() {
+function showTrending(data) {
     try {
         // Reusing new-releases for trending as per original template logic
-        const response = await fetch('/api/home/new-releases');
-        const data = await response.json();
         const results = data.results || data;
         if (results) {
             renderTrending(results.slice(0, 9), 'top-trending');
         }
     } catch (error) {
-        console.error('Error fetching trending:', error);
+        console.error('Error rendering trending:', error);
     }
 }
 
-async function fetchSchedule() {
+function showSchedule(data) {
     try {
-        const response = await fetch('/api/home/schedule');
-        const data = await response.json();
         const results = data.results || data;
         if (results) {
             renderSchedule(results.slice(0, 9), 'schedule-list');
         }
     } catch (error) {
-        console.error('Error fetching schedule:', error);
+        console.error('Error rendering schedule:', error);
     }
 }
 